@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import threading
+
+from cache import AudioCache
+from player import Player, decode, getSilence
+from tts import LocalTts as Tts
+
+
+# Letters a-z of one voice, decoded once and kept in memory, so a word is
+# spelled by a single playback of the letters joined with silence.
+class LetterBank:
+
+    LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+    _banks = dict()
+    _mutex = threading.Lock()
+
+    def __init__(self, language, voiceIndex, speed):
+
+        self.letters = dict()
+        self.params = None
+
+        tts = Tts()
+        tts.setLanguage(language)
+        tts.voiceIndex = voiceIndex
+
+        cache = AudioCache.get()
+
+        for letter in LetterBank.LETTERS:
+
+            key, generate = tts.prepare(letter, speed)
+
+            pathname = cache.fetch(key, generate)
+            if pathname is None:
+                print('Failed to render letter', letter)
+                continue
+
+            params, frames = decode(pathname)
+
+            if self.params is None:
+                self.params = params
+            elif self.params != params:
+                print('Letter', letter, 'has different parameters', params, '!=', self.params)
+                continue
+
+            self.letters[letter] = frames
+
+    @staticmethod
+    def get(language='english', voiceIndex=0, speed=1.0):
+
+        key = (language, voiceIndex, speed)
+
+        with LetterBank._mutex:
+
+            if key not in LetterBank._banks.keys():
+                LetterBank._banks[key] = LetterBank(language, voiceIndex, speed)
+
+            return LetterBank._banks[key]
+
+    def spell(self, letters, gap):
+
+        silence = getSilence(self.params, gap)
+
+        frames = [self.letters[letter] for letter in letters if letter in self.letters.keys()]
+
+        return silence.join(frames)
+
+    def play(self, letters, gap=0.1, cancelEvent=None):
+
+        if self.params is None or not letters:
+            return
+
+        if cancelEvent is not None and cancelEvent.is_set():
+            return
+
+        Player.get().playPcm(self.params, self.spell(letters, gap))
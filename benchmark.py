@@ -0,0 +1,622 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import hashlib
+import json
+import math
+import os
+import pyttsx3
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from bundle import SynonymBundle, zstandard
+from cache import AudioCache
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from network import Network
+from phrase import Category, Phrase, Sentence
+from player import MplayerPlayer, PcmPlayer, PipePlayer, simpleaudio
+from review import ReviewScheduler
+from tts import LocalEngine, LocalTts, Tts
+from utils import prGreen, prRed, prCyan, prYellow
+
+
+def report(name, durations):
+
+    if len(durations) == 0:
+        prRed('{}: nothing is measured'.format(name))
+        return
+
+    durations = sorted(durations)
+    p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+
+    prCyan('{:24} count {:5}  total {:8.3f}s  mean {:8.2f}ms  median {:8.2f}ms  p95 {:8.2f}ms'.format(
+        name, len(durations), sum(durations),
+        statistics.mean(durations) * 1000,
+        statistics.median(durations) * 1000,
+        p95 * 1000))
+
+
+def measure(function, *args):
+
+    startTime = time.perf_counter()
+    function(*args)
+
+    return time.perf_counter() - startTime
+
+
+def getLessonTexts(pathname):
+
+    with open(pathname) as fp:
+        contents = json.loads(fp.read())['contents-list']
+
+    texts = []
+
+    for content in contents:
+
+        texts.append(('english', content['word'].strip()))
+        texts.append(('chinese', content['chinese'].strip()))
+        texts.append(('english', content['explanation'].strip()))
+
+        for sample in content['samples']:
+            texts.append(('english', sample.strip()))
+
+        for ch in content['word'].lower():
+            if ch >= 'a' and ch <= 'z':
+                texts.append(('english', ch))
+
+    return [(language, text) for language, text in texts if len(text) > 0]
+
+
+def benchmarkTts(argv):
+
+    if len(argv) < 1:
+        print('Usage:\n\t tts LESSON-JSON\n')
+        return
+
+    texts = getLessonTexts(argv[0])
+    prGreen('{} utterances in {}'.format(len(texts), argv[0]))
+
+    ttses = dict()
+    for language in ['english', 'chinese']:
+        tts = LocalTts()
+        tts.setLanguage(language)
+        tts.switchVoice()
+        ttses[language] = tts
+
+    with tempfile.TemporaryDirectory() as dirname:
+
+        # What LocalTts did before: a new engine for every utterance.
+        durations = []
+        for index, (language, text) in enumerate(texts):
+            pathname = os.path.join(dirname, 'init-{}.mp3'.format(index))
+
+            start = time.perf_counter()
+
+            engine = pyttsx3.init()
+            engine.setProperty('voice', ttses[language].getVoiceId())
+            engine.setProperty('rate', LocalEngine.DEFAULT_RATE)
+            engine.save_to_file(text, pathname)
+            engine.runAndWait()
+            engine.stop()
+            del engine
+
+            durations.append(time.perf_counter() - start)
+
+        report('init per utterance', durations)
+
+        durations = []
+        for index, (language, text) in enumerate(texts):
+            pathname = os.path.join(dirname, 'engine-{}.mp3'.format(index))
+
+            start = time.perf_counter()
+
+            LocalEngine.get().save(ttses[language].getVoiceId(),
+                                   LocalEngine.DEFAULT_RATE, text, pathname)
+
+            durations.append(time.perf_counter() - start)
+
+        report('persistent engine', durations)
+
+        LocalEngine.get().shutdown()
+
+
+def benchmarkPlayer(argv):
+
+    if len(argv) < 1:
+        print('Usage:\n\t player CLIP [NUMBER]\n')
+        return
+
+    pathname = os.path.realpath(argv[0])
+
+    number = 100
+    if len(argv) > 1:
+        number = int(argv[1])
+
+    players = [('mplayer', MplayerPlayer()), ('pipe', PipePlayer())]
+
+    if simpleaudio is not None:
+        players.append(('pcm', PcmPlayer()))
+    else:
+        prYellow('No simpleaudio, skip pcm player')
+
+    for name, player in players:
+
+        durations = []
+
+        for index in range(number):
+
+            start = time.perf_counter()
+            player.play(pathname)
+            durations.append(time.perf_counter() - start)
+
+        player.close()
+
+        report(name, durations)
+
+
+# Answer every request with a short mp3 after a delay, like the TTS server
+class StubTtsHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True
+
+    DELAY = 0.02  # seconds
+    CONTENT = b'\xff\xfb' * 512
+
+    connections = 0
+    requests = 0
+    mutex = threading.Lock()
+
+    def setup(self):
+
+        super().setup()
+
+        with StubTtsHandler.mutex:
+            StubTtsHandler.connections += 1
+
+    def do_GET(self):
+
+        with StubTtsHandler.mutex:
+            StubTtsHandler.requests += 1
+
+        time.sleep(StubTtsHandler.DELAY)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('Content-Length', '{}'.format(len(StubTtsHandler.CONTENT)))
+        self.end_headers()
+
+        self.wfile.write(StubTtsHandler.CONTENT)
+
+    def log_message(self, format, *args):
+        pass
+
+    @staticmethod
+    def reset():
+
+        with StubTtsHandler.mutex:
+            StubTtsHandler.connections = 0
+            StubTtsHandler.requests = 0
+
+
+def benchmarkNetwork(argv):
+
+    number = 50
+    if len(argv) > 0:
+        number = int(argv[0])
+
+    concurrency = Network.CONCURRENCY
+    if len(argv) > 1:
+        concurrency = int(argv[1])
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubTtsHandler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    Network.setRateLimit(10000, 10000)
+
+    tts = Tts()
+    tts.config['url'] = 'http://127.0.0.1:{}/gen.php?'.format(server.server_address[1])
+    tts.setLanguage('english')
+    tts.switchVoice()
+
+    isPassed = True
+
+    with tempfile.TemporaryDirectory() as dirname:
+
+        for name in ['sequential', 'batch']:
+
+            AudioCache.init(os.path.join(dirname, name))
+            StubTtsHandler.reset()
+
+            texts = ['{} text {}'.format(name, index) for index in range(number)]
+
+            start = time.perf_counter()
+
+            if 'batch' == name:
+                pathnames = tts.renderAll(texts, concurrency)
+            else:
+                pathnames = [tts.render(text) for text in texts]
+
+            duration = time.perf_counter() - start
+
+            failedCount = len([pathname for pathname in pathnames if pathname is None])
+
+            for pathname in pathnames:
+                if pathname is not None:
+                    with open(pathname, 'rb') as fp:
+                        if fp.read() != StubTtsHandler.CONTENT:
+                            prRed('Different: {}'.format(pathname))
+                            failedCount += 1
+
+            if failedCount > 0 or StubTtsHandler.connections > Network.POOL_SIZE:
+                isPassed = False
+
+            prCyan('{:24} texts {:5}  failed {:3}  total {:8.3f}s  requests {:5}  connections {:3}'.format(
+                name, number, failedCount, duration,
+                StubTtsHandler.requests, StubTtsHandler.connections))
+
+        AudioCache.get().save()
+
+    prCyan('Network: {}'.format(Network.getStats()))
+
+    server.shutdown()
+
+    return isPassed
+
+PHRASE_PATH = os.path.join('english', 'synonym', '9988')
+PHRASE_REGRESSION = os.path.join('samples', 'phrase-regression.json')
+
+
+# Digest of everything the rules decide for the lines
+def getPhraseDigest(lines):
+
+    m = hashlib.sha1()
+
+    for line in lines:
+        m.update(json.dumps([Category.findall(line), Sentence.refine(line)]).encode('utf-8'))
+        m.update(b'\n')
+
+    return m.hexdigest()
+
+
+def benchmarkPhrase(argv):
+
+    isRecording = '--record' in argv
+    argv = [arg for arg in argv if arg != '--record']
+
+    dirname = os.path.dirname(os.path.realpath(__file__))
+
+    path = os.path.join(dirname, PHRASE_PATH)
+    if len(argv) > 0:
+        path = argv[0]
+
+    regressionPath = os.path.join(dirname, PHRASE_REGRESSION)
+
+    digests = dict()
+    durations = []
+    lineCount = 0
+
+    for filename in sorted(os.listdir(path)):
+
+        if not filename.endswith('.txt'):
+            continue
+
+        with open(os.path.join(path, filename)) as fp:
+            lines = fp.read().splitlines()
+
+        startTime = time.perf_counter()
+        digests[filename] = getPhraseDigest(lines)
+        durations.append(time.perf_counter() - startTime)
+
+        lineCount += len(lines)
+
+    report('phrase', durations)
+    prCyan('{} lines, {:.0f} lines/s'.format(lineCount, lineCount / sum(durations)))
+
+    if isRecording:
+        with open(regressionPath, 'w') as fp:
+            fp.write(json.dumps(digests, indent=4, sort_keys=True))
+
+        prGreen('Recorded {} files into {}'.format(len(digests), regressionPath))
+        return
+
+    with open(regressionPath) as fp:
+        expectedDigests = json.loads(fp.read())
+
+    differences = [filename for filename in digests.keys()
+            if filename in expectedDigests.keys() and digests[filename] != expectedDigests[filename]]
+
+    for filename in differences:
+        prRed('Different: {}'.format(filename))
+
+    prGreen('{} files are checked, {} are different'.format(len(digests), len(differences)))
+
+    return len(differences) == 0
+
+
+def getPhraseLines(path):
+
+    lines = []
+
+    for filename in sorted(os.listdir(path)):
+        if filename.endswith('.txt'):
+            with open(os.path.join(path, filename)) as fp:
+                lines.extend(fp.read().splitlines())
+
+    return lines
+
+
+# Check Phrase.find against findContinuousRange on random and real lines,
+# then time both on pages pasted as single lines
+def benchmarkRange(argv):
+
+    number = 100000
+    if len(argv) > 0:
+        number = int(argv[0])
+
+    def findOld(string):
+        return Phrase.findContinuousRange(Phrase.multiFindAll(Phrase.REGEXES, string))
+
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), PHRASE_PATH)
+    lines = getPhraseLines(path)
+
+    random.seed(number)
+    characters = "ab1'() ,.%$-\t;:中"
+
+    randomLines = [''.join([random.choice(characters) for _ in range(random.randint(0, 24))])
+            for _ in range(number)]
+
+    differentCount = 0
+
+    for line in lines + randomLines:
+
+        expected = findOld(line)
+        found = Phrase.find(line)
+
+        if expected != found:
+            differentCount += 1
+            prRed('Different: {!r} {} != {}'.format(line, found, expected))
+
+    prGreen('{} real and {} random lines are checked, {} are different'.format(
+        len(lines), len(randomLines), differentCount))
+
+    # Long pages which are continued to the end, the worst case
+    pages = [re.sub(r"[^a-zA-Z0-9' ,\.%$\-]+", ' ', ' '.join(lines[index:index + 200]))
+            for index in range(0, len(lines), 200)]
+
+    for name, find in [('range (lanes)', findOld), ('range (sweep)', Phrase.find)]:
+
+        durations = []
+
+        for page in pages:
+            startTime = time.perf_counter()
+            find(page)
+            durations.append(time.perf_counter() - startTime)
+
+        report(name, durations)
+
+    return differentCount == 0
+
+
+# Convert a compressed JSON export of synonym.py into bundles, and compare
+# their sizes and the time to load them
+def benchmarkBundle(argv):
+
+    if len(argv) < 1:
+        print('Usage:\n\t bundle COMPRESSED-SYNONYM-JSON [NUMBER]\n')
+        return
+
+    number = 20
+    if len(argv) > 1:
+        number = int(argv[1])
+
+    with open(argv[0], 'rb') as fp:
+        data = fp.read()
+
+    content = json.loads(data)
+    synonyms = content['s']
+    keys = list(synonyms.keys())
+
+    prCyan('{:24} {:10} bytes'.format('json', len(data)))
+
+    def loadJson():
+        with open(argv[0]) as fp:
+            synonyms = json.loads(fp.read())['s']
+            return synonyms[keys[len(keys) // 2]]
+
+    report('load json', [measure(loadJson) for _ in range(number)])
+
+    compressions = ['none', 'gzip']
+    if zstandard is not None:
+        compressions.append('zstd')
+
+    isPassed = True
+
+    with tempfile.TemporaryDirectory() as dirname:
+
+        for compression in compressions:
+
+            pathname = os.path.join(dirname, '{}{}'.format(compression, SynonymBundle.SUFFIX))
+            size = SynonymBundle.save(pathname, content['d'], synonyms, compression)
+
+            with SynonymBundle(pathname) as bundle:
+                if json.loads(json.dumps(dict(bundle))) != synonyms:
+                    prRed('Different: {}'.format(compression))
+                    isPassed = False
+
+            prCyan('{:24} {:10} bytes'.format('bundle ({})'.format(compression), size))
+
+            # Open it and look up one, as the app does for a word
+            def loadBundle():
+                with SynonymBundle(pathname) as bundle:
+                    return bundle.getRecord(len(bundle) // 2)
+
+            report('load bundle ({})'.format(compression), [measure(loadBundle) for _ in range(number)])
+
+    return isPassed
+
+
+# Study a page of synonyms once a day with a simulated learner, and count
+# the prompts of full rounds against those of the scheduler. A pair is
+# recalled with exp(-days / span), the span starts with SPAN days when it is
+# learnt, which is 90% the next day, and grows by the easiness of the pair
+# whenever it is recalled. The easiness is the state of the scheduler, or the
+# initial one of SM-2 for rounds. Only the first prompt of a pair a day is
+# graded, as SynonymChapter.studyRows does.
+def benchmarkReview(argv):
+
+    number = 100
+    if len(argv) > 0:
+        number = int(argv[0])
+
+    days = 30
+    if len(argv) > 1:
+        days = int(argv[1])
+
+    day = ReviewScheduler.DAY
+
+    SPAN = 10  # days
+
+    def simulate(name, study, getEasiness):
+
+        random.seed(number)
+
+        spans = dict()
+        lastTimes = dict()
+
+        def recall(key, now):
+
+            span = spans.get(key, 0)
+            isRecalled = span > 0 and random.random() < math.exp(-(now - lastTimes[key]) / day / span)
+
+            spans[key] = span * getEasiness(key) if isRecalled else SPAN
+            lastTimes[key] = now
+
+            return isRecalled
+
+        keys = ['pair-{}'.format(index) for index in range(number)]
+        prompts = []
+
+        for index in range(days):
+            prompts.append(study(keys, index * day, recall))
+
+        now = days * day
+        retention = sum(math.exp(-(now - lastTimes[key]) / day / spans[key]) for key in keys) / number
+
+        prCyan('{:24} {:8} prompts, {:6.1f} a day, {:4.0f}% are remembered at last'.format(
+            name, sum(prompts), statistics.mean(prompts), retention * 100))
+
+    # The former SynonymChapter.studyRows, rounds until every one is skipped
+    def studyRounds(keys, now, recall):
+
+        prompts = 0
+
+        while keys:
+            prompts += len(keys)
+            keys = [key for key in keys if not recall(key, now)]
+
+        return prompts
+
+    states = dict()
+
+    def studyDue(keys, now, recall):
+
+        scheduler = ReviewScheduler()
+        scheduler.states = states
+
+        for key in keys:
+            scheduler.add(key)
+
+        prompts = 0
+        reviewedKeys = set()
+
+        while True:
+
+            key = scheduler.pop(now)
+            if key is None:
+                break
+
+            prompts += 1
+
+            isRecalled = recall(key, now)
+
+            if key in reviewedKeys:
+                if not isRecalled:
+                    scheduler.repeat(key, now)
+            elif isRecalled:
+                scheduler.review(key, ReviewScheduler.REMEMBERED, now)
+                reviewedKeys.add(key)
+            else:
+                scheduler.review(key, ReviewScheduler.FORGOTTEN, now)
+                reviewedKeys.add(key)
+
+        return prompts
+
+    def getEasiness(key):
+
+        state = states.get(key)
+        if state is None:
+            return ReviewScheduler.EASINESS
+
+        return state['easiness']
+
+    prGreen('{} pairs are studied for {} days'.format(number, days))
+
+    simulate('rounds', studyRounds, lambda key: ReviewScheduler.EASINESS)
+    simulate('scheduler', studyDue, getEasiness)
+
+
+BENCHMARKS = {
+    'bundle': benchmarkBundle,
+    'network': benchmarkNetwork,
+    'phrase': benchmarkPhrase,
+    'range': benchmarkRange,
+    'review': benchmarkReview,
+    'player': benchmarkPlayer,
+    'tts': benchmarkTts,
+}
+
+
+# Return the exit status, which is not 0 if a benchmark fails its check
+def main(argv):
+
+    if len(argv) < 2 or argv[1] not in BENCHMARKS.keys():
+        print('Usage:\n\t', argv[0], '[{}] ...\n'.format('|'.join(BENCHMARKS.keys())))
+        return 2
+
+    status = 0
+
+    try:
+        prYellow('Now: {}'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+        # A benchmark with checks returns False if any fails
+        if BENCHMARKS[argv[1]](argv[2:]) is False:
+            prRed('Failed: {}'.format(argv[1]))
+            status = 1
+
+    except KeyboardInterrupt:
+        status = 1
+    except Exception as e:
+        prRed('Error occurs at {}'.format(
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        traceback.print_exc(file=sys.stdout)
+        status = 1
+    finally:
+        pass
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import gzip
+import mmap
+import struct
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# A compact file of synonyms for the client app, instead of the JSON one.
+#
+#   header  magic, version, compression, date, string number, record number
+#   body    offsets of strings (string number + 1), records, UTF-8 strings
+#
+# Every string is stored once. A record is ten numbers: the indexes of key,
+# w1, w2, e1, e2, both positions of a1 and of a2, and the chapter itself.
+# The body is compressed as a whole if it is asked for, otherwise it is
+# read in place through mmap. Either way records are decoded on demand.
+class SynonymBundle:
+
+    SUFFIX = '.bundle'
+
+    MAGIC = b'SYNB'
+    VERSION = 1
+
+    HEADER = struct.Struct('<4sHHqII')
+    OFFSET = struct.Struct('<I')
+    RECORD = struct.Struct('<10I')
+
+    COMPRESSIONS = ['none', 'gzip', 'zstd']
+
+    def __init__(self, pathname):
+
+        self.fp = open(pathname, 'rb')
+        self.mmap = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, compression, self.date, self.stringNum, self.recordNum = \
+                SynonymBundle.HEADER.unpack_from(self.mmap, 0)
+
+        if magic != SynonymBundle.MAGIC or version != SynonymBundle.VERSION:
+            self.close()
+            raise ValueError('{} is not a synonym bundle of version {}'.format(
+                pathname, SynonymBundle.VERSION))
+
+        self.compression = SynonymBundle.COMPRESSIONS[compression]
+
+        body = memoryview(self.mmap)[SynonymBundle.HEADER.size:]
+
+        if 'gzip' == self.compression:
+            body = memoryview(gzip.decompress(body))
+        elif 'zstd' == self.compression:
+            body = memoryview(SynonymBundle.getZstd().ZstdDecompressor().decompressobj().decompress(body))
+
+        self.body = body
+
+        self.recordsOffset = SynonymBundle.OFFSET.size * (self.stringNum + 1)
+        self.stringsOffset = self.recordsOffset + SynonymBundle.RECORD.size * self.recordNum
+
+        self.strings = dict()
+        self.keyIndexes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.recordNum
+
+    def __iter__(self):
+
+        for index in range(self.recordNum):
+            yield self.getRecord(index)
+
+    @staticmethod
+    def getZstd():
+
+        if zstandard is None:
+            raise ValueError('Not support zstd without zstandard')
+
+        return zstandard
+
+    def close(self):
+
+        # Views of the map have to be released before it is closed
+        self.body = None
+
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def getString(self, index):
+
+        string = self.strings.get(index)
+        if string is not None:
+            return string
+
+        start, = SynonymBundle.OFFSET.unpack_from(self.body, SynonymBundle.OFFSET.size * index)
+        end, = SynonymBundle.OFFSET.unpack_from(self.body, SynonymBundle.OFFSET.size * (index + 1))
+
+        string = bytes(self.body[self.stringsOffset + start:self.stringsOffset + end]).decode('utf-8')
+        self.strings[index] = string
+
+        return string
+
+    # Return (key, synonym) in the form of SynonymBook.toDict with compress
+    def getRecord(self, index):
+
+        values = SynonymBundle.RECORD.unpack_from(self.body,
+                self.recordsOffset + SynonymBundle.RECORD.size * index)
+
+        strings = [self.getString(value) for value in values[:9]]
+
+        synonym = {
+            'w1': strings[1],
+            'w2': strings[2],
+            'e1': strings[3],
+            'e2': strings[4],
+            'a1': [strings[5], strings[6]],
+            'a2': [strings[7], strings[8]],
+            'c': values[9],
+        }
+
+        return strings[0], synonym
+
+    def get(self, key):
+
+        if self.keyIndexes is None:
+
+            self.keyIndexes = dict()
+
+            for index in range(self.recordNum):
+                values = SynonymBundle.RECORD.unpack_from(self.body,
+                        self.recordsOffset + SynonymBundle.RECORD.size * index)
+                self.keyIndexes[self.getString(values[0])] = index
+
+        index = self.keyIndexes.get(key)
+        if index is None:
+            return None
+
+        return self.getRecord(index)[1]
+
+    # synonyms is the dict of SynonymBook.toDict with compress
+    @staticmethod
+    def save(pathname, date, synonyms, compression='none'):
+
+        strings = []
+        indexes = dict()
+
+        def intern(string):
+
+            index = indexes.get(string)
+
+            if index is None:
+                index = len(strings)
+                indexes[string] = index
+                strings.append(string)
+
+            return index
+
+        records = []
+
+        for key, synonym in synonyms.items():
+
+            a1 = synonym['a1']
+            a2 = synonym['a2']
+
+            records.append(SynonymBundle.RECORD.pack(
+                intern(key), intern(synonym['w1']), intern(synonym['w2']),
+                intern(synonym['e1']), intern(synonym['e2']),
+                intern(a1[0]), intern(a1[1]), intern(a2[0]), intern(a2[1]),
+                synonym['c']))
+
+        offsets = []
+        blobs = []
+        offset = 0
+
+        for string in strings:
+
+            blob = string.encode('utf-8')
+
+            offsets.append(SynonymBundle.OFFSET.pack(offset))
+            blobs.append(blob)
+
+            offset += len(blob)
+
+        offsets.append(SynonymBundle.OFFSET.pack(offset))
+
+        body = b''.join(offsets + records + blobs)
+
+        if 'gzip' == compression:
+            body = gzip.compress(body, mtime=0)
+        elif 'zstd' == compression:
+            body = SynonymBundle.getZstd().ZstdCompressor(level=19).compress(body)
+
+        header = SynonymBundle.HEADER.pack(SynonymBundle.MAGIC, SynonymBundle.VERSION,
+                SynonymBundle.COMPRESSIONS.index(compression), date, len(strings), len(records))
+
+        with open(pathname, 'wb') as fp:
+            fp.write(header)
+            fp.write(body)
+
+        return len(header) + len(body)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from utils import mkdir, remove, reprDict, writeAtomically
+
+
+# Audio rendered by any TTS backend, stored under a key of everything that
+# changes the sound: (text, language, voiceId, rate, backend). The index file
+# keeps the size and the last access time of every entry, so a lookup never
+# touches the disk and the least recently used entries go first when the
+# cache grows beyond its cap. Processes share the index: the changes of one
+# are merged into the index on the disk under a lock file when it is saved.
+class AudioCache:
+
+    DEFAULT_PATH = 'audio-cache'
+    DEFAULT_MAX_SIZE = 512 * 1024 * 1024  # 512M
+
+    INDEX_FILENAME = 'index.json'
+    LOCK_FILENAME = 'index.lock'
+    SAVE_INTERVAL = 5  # seconds
+
+    # Temporary files are named with the PID of the rendering process
+    TEMP_REGEX = re.compile(r'\.(\d+)(-\d+)?\.tmp')
+    TEMP_AGE = 60 * 60  # seconds
+
+    _instance = None
+
+    def __init__(self, dirname, maxSize=DEFAULT_MAX_SIZE):
+
+        self.dirname = os.path.realpath(dirname)
+        self.indexPath = os.path.join(self.dirname, AudioCache.INDEX_FILENAME)
+        self.lockPath = os.path.join(self.dirname, AudioCache.LOCK_FILENAME)
+
+        self.maxSize = maxSize
+
+        self.entries = dict()
+        self.size = 0
+
+        # Keys added, accessed or evicted since the last save
+        self.changedKeys = set()
+        self.removedKeys = set()
+
+        self.isDirty = False
+        self.saveTime = 0
+
+        self.mutex = threading.RLock()
+
+        mkdir(self.dirname)
+
+        self.load()
+
+        atexit.register(self.save)
+
+    @staticmethod
+    def init(dirname=None, maxSize=DEFAULT_MAX_SIZE):
+
+        if dirname is None:
+            dirname = AudioCache.DEFAULT_PATH
+
+        if AudioCache._instance is not None:
+            AudioCache._instance.save()
+
+        AudioCache._instance = AudioCache(dirname, maxSize)
+
+        return AudioCache._instance
+
+    @staticmethod
+    def get():
+
+        if AudioCache._instance is None:
+            AudioCache._instance = AudioCache(AudioCache.DEFAULT_PATH)
+
+        return AudioCache._instance
+
+    @staticmethod
+    def getKey(text, language, voiceId, rate, backend):
+
+        m = hashlib.sha1()
+
+        for value in [backend, language, voiceId, rate, text]:
+            m.update('{}'.format(value).encode('utf-8'))
+            m.update(b'\0')
+
+        return m.hexdigest()
+
+    def read(self):
+
+        if not os.path.exists(self.indexPath):
+            return dict()
+
+        try:
+            with open(self.indexPath) as fp:
+                return json.loads(fp.read())
+        except ValueError as e:
+            print('Error to load', self.indexPath, ':', e)
+
+        return dict()
+
+    def load(self):
+
+        self.entries = self.read()
+        self.size = sum([entry['size'] for entry in self.entries.values()])
+
+    # Apply the changes of this process to the index on the disk, the later
+    # access of an entry wins
+    def merge(self):
+
+        entries = self.read()
+
+        for key in self.removedKeys:
+            entries.pop(key, None)
+
+        for key in self.changedKeys:
+
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+
+            diskEntry = entries.get(key)
+
+            if diskEntry is None:
+                # Evicted by another process
+                if not os.path.exists(self.getPathname(entry)):
+                    continue
+            elif diskEntry['time'] >= entry['time']:
+                continue
+
+            entries[key] = entry
+
+        self.entries = entries
+        self.size = sum([entry['size'] for entry in self.entries.values()])
+
+    def save(self):
+
+        with self.mutex:
+
+            if not self.isDirty:
+                return
+
+            with open(self.lockPath, 'a') as lockFp:
+
+                fcntl.flock(lockFp, fcntl.LOCK_EX)
+
+                try:
+                    self.merge()
+                    self.evict()
+
+                    writeAtomically(self.indexPath, reprDict(self.entries, indent=None))
+                finally:
+                    fcntl.flock(lockFp, fcntl.LOCK_UN)
+
+            self.changedKeys = set()
+            self.removedKeys = set()
+
+            self.isDirty = False
+            self.saveTime = time.time()
+
+    @staticmethod
+    def isAlive(pid):
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+
+        return True
+
+    # Remove files left by renderings which were interrupted, the ones of
+    # living processes are kept unless they are too old
+    def cleanup(self):
+
+        now = time.time()
+
+        for filename in os.listdir(self.dirname):
+
+            if '.tmp' not in filename:
+                continue
+
+            pathname = os.path.join(self.dirname, filename)
+
+            try:
+                isOld = now - os.path.getmtime(pathname) > AudioCache.TEMP_AGE
+            except OSError:
+                continue
+
+            match = AudioCache.TEMP_REGEX.search(filename)
+            isOrphan = match is not None and not AudioCache.isAlive(int(match.group(1)))
+
+            if isOld or isOrphan:
+                remove(pathname)
+
+    def getTempPrefix(self, key):
+        return os.path.join(self.dirname, '{}.{}-{}.tmp'.format(
+            key, os.getpid(), threading.get_ident()))
+
+    def getPathname(self, entry):
+        return os.path.join(self.dirname, entry['filename'])
+
+    def lookup(self, key):
+
+        with self.mutex:
+
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            pathname = self.getPathname(entry)
+
+            # Evicted by another process, so render it again
+            if not os.path.exists(pathname):
+                self.drop(key)
+                return None
+
+            entry['time'] = time.time()
+
+            self.changedKeys.add(key)
+            self.isDirty = True
+
+            return pathname
+
+    def drop(self, key):
+
+        entry = self.entries.pop(key)
+        self.size -= entry['size']
+
+        self.changedKeys.discard(key)
+        self.removedKeys.add(key)
+        self.isDirty = True
+
+    # generate(prefix) renders into a file starting with prefix and returns
+    # its pathname, which is moved into place only once it is complete.
+    def fetch(self, key, generate):
+
+        pathname = self.lookup(key)
+        if pathname is not None:
+            return pathname
+
+        tempPathname = None
+
+        try:
+            tempPathname = generate(self.getTempPrefix(key))
+
+            if tempPathname is None or not os.path.exists(tempPathname):
+                return None
+
+            if os.path.getsize(tempPathname) == 0:
+                print('Empty rendering of', key)
+                return None
+
+            return self.add(key, tempPathname)
+
+        finally:
+            if tempPathname is not None:
+                remove(tempPathname)
+
+    def add(self, key, tempPathname):
+
+        _, suffix = os.path.splitext(tempPathname)
+
+        entry = {
+            'filename': '{}{}'.format(key, suffix),
+            'size': os.path.getsize(tempPathname),
+            'time': time.time(),
+        }
+
+        pathname = self.getPathname(entry)
+        os.replace(tempPathname, pathname)
+
+        with self.mutex:
+
+            oldEntry = self.entries.get(key)
+            if oldEntry is not None:
+                self.size -= oldEntry['size']
+
+            self.entries[key] = entry
+            self.size += entry['size']
+
+            self.changedKeys.add(key)
+            self.removedKeys.discard(key)
+            self.isDirty = True
+
+            self.evict(key)
+
+            if time.time() - self.saveTime > AudioCache.SAVE_INTERVAL:
+                self.save()
+
+        return pathname
+
+    def evict(self, keptKey=None):
+
+        if self.size <= self.maxSize:
+            return
+
+        keys = sorted(self.entries.keys(), key=lambda key: self.entries[key]['time'])
+
+        for key in keys:
+
+            if self.size <= self.maxSize:
+                break
+
+            if key == keptKey:
+                continue
+
+            pathname = self.getPathname(self.entries[key])
+
+            self.drop(key)
+            remove(pathname)
@@ -5,6 +5,8 @@ import os
 import sys
 import time
 
+from cache import AudioCache
+from player import Player
 from proc import Lesson
 from utils import getProperty
 
@@ -14,6 +16,9 @@ def run(name, configFile):
     sourcePath = getProperty(configFile, 'source-path')
     outputPath = getProperty(configFile, 'output-path')
 
+    AudioCache.init(getProperty(configFile, 'audio-cache-path'))
+    Player.init(getProperty(configFile, 'audio-player'))
+
     lesson = Lesson(sourcePath, outputPath)
     lesson.start()
 
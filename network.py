@@ -1,72 +1,302 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import os
 import random
 import requests
+import threading
 import time
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from utils import chmod, remove
+
+
+# Allow rate requests per second on average and burst of them at once
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+
+        self.rate = rate
+        self.burst = burst
+
+        self.tokens = burst
+        self.lastTime = time.monotonic()
+
+        self.mutex = threading.Lock()
+
+    def acquire(self):
+
+        while True:
+
+            with self.mutex:
+
+                now = time.monotonic()
+
+                self.tokens = min(self.burst, self.tokens + (now - self.lastTime) * self.rate)
+                self.lastTime = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                seconds = (1 - self.tokens) / self.rate
+
+            time.sleep(seconds)
+
+
+# Exponential backoff with full jitter. Connection errors and statuses in
+# STATUSES are retried, waiting for Retry-After if the server asks for it,
+# until attempts are used up or the deadline would be passed.
+class RetryPolicy:
+
+    STATUSES = [429, 500, 502, 503, 504]
+
+    def __init__(self, attempts=3, baseDelay=0.5, maxDelay=30, deadline=120):
+
+        self.attempts = attempts
+
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+
+        self.deadline = deadline
+
+    def shouldRetry(self, r):
+        return r is None or r.status_code in RetryPolicy.STATUSES
+
+    @staticmethod
+    def getRetryAfter(r):
+
+        if r is None or 'Retry-After' not in r.headers.keys():
+            return None
+
+        value = r.headers['Retry-After'].strip()
+
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def getDelay(self, attempt, r=None):
+
+        delay = RetryPolicy.getRetryAfter(r)
+        if delay is not None:
+            return min(delay, self.maxDelay)
+
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * (2 ** attempt)))
+
+
+# Stop sending requests to a host after continuous failures for a while,
+# then let one through to find out whether it is back.
+class CircuitBreaker:
+
+    THRESHOLD = 5
+    COOLDOWN = 30  # seconds
+
+    def __init__(self):
+
+        self.hosts = dict()
+        self.mutex = threading.Lock()
+
+    def isAllowed(self, host):
+
+        with self.mutex:
+
+            state = self.hosts.get(host)
+
+            if state is None or state['failures'] < CircuitBreaker.THRESHOLD:
+                return True
+
+            now = time.monotonic()
+
+            if now - state['openedTime'] < CircuitBreaker.COOLDOWN:
+                return False
+
+            # Half open
+            state['openedTime'] = now
+            return True
+
+    def record(self, host, succeeded):
+
+        with self.mutex:
+
+            if succeeded:
+                self.hosts.pop(host, None)
+                return
+
+            state = self.hosts.setdefault(host, {'failures': 0, 'openedTime': 0})
+
+            state['failures'] += 1
+            if state['failures'] >= CircuitBreaker.THRESHOLD:
+                state['openedTime'] = time.monotonic()
 
-from utils import chmod
 
 class Network:
 
     _instance = None
     timeout = 10
 
+    POOL_SIZE = 8
+    CONCURRENCY = 4
+
+    RATE = 2  # requests per second
+    BURST = 4
+
+    CHUNK_SIZE = 64 * 1024
+    RESUME_TIMES = 3
+
+    # Content type -> suffix of saved files, extended by registerContentType
+    CONTENT_TYPES = {
+        'image/jpeg': '.jpg',
+        'image/png': '.png',
+        'image/gif': '.gif',
+        'audio/mpeg': '.mp3',
+    }
+
     def __init__(self):
+
         self.isEnabled = True
 
+        # Keep connections alive between requests
+        self.session = requests.Session()
+
+        adapter = HTTPAdapter(pool_connections=Network.POOL_SIZE,
+                              pool_maxsize=Network.POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.rateLimiter = TokenBucket(Network.RATE, Network.BURST)
+
+        self.retryPolicy = RetryPolicy()
+        self.circuitBreaker = CircuitBreaker()
+
+        self.stats = dict()
+        self.mutex = threading.Lock()
+
     @staticmethod
-    def setIsEnabled(isEnabled):
+    def getInstance():
 
         if Network._instance is None:
             Network._instance = Network()
 
-        Network._instance.isEnabled = isEnabled
+        return Network._instance
+
+    @staticmethod
+    def setIsEnabled(isEnabled):
+        Network.getInstance().isEnabled = isEnabled
+
+    @staticmethod
+    def setRateLimit(rate, burst):
+        Network.getInstance().rateLimiter = TokenBucket(rate, burst)
+
+    @staticmethod
+    def setRetryPolicy(retryPolicy):
+        Network.getInstance().retryPolicy = retryPolicy
 
     @staticmethod
-    def get(url, params=None, retries=1, **kwargs):
+    def getStats():
+
+        instance = Network.getInstance()
+
+        with instance.mutex:
+            return dict(instance.stats)
+
+    def count(self, name):
+
+        with self.mutex:
+            self.stats[name] = self.stats.get(name, 0) + 1
 
-        if not Network._instance.isEnabled:
+    def request(self, method, url, retries=None, **kwargs):
+
+        if not self.isEnabled:
             return None
 
+        if retries is None:
+            retries = self.retryPolicy.attempts
+
+        kwargs.setdefault('timeout', Network.timeout)
+
+        host = urllib.parse.urlsplit(url).netloc
+        startTime = time.monotonic()
+
+        r = None
+
         for i in range(retries):
+
+            if not self.circuitBreaker.isAllowed(host):
+                print('Circuit is open for', host, ', skip', url)
+                self.count('rejected')
+                break
+
+            self.rateLimiter.acquire()
+            self.count('requests')
+
             try:
-                return requests.get(url, params=params, timeout=Network.timeout, **kwargs)
+                r = self.session.request(method, url, **kwargs)
             except Exception as e:
-                print('Error to get', url, ':', e)
+                print('Error to {}'.format(method.lower()), url, ':', e)
+                self.count('errors')
+                r = None
 
-            if i > 0:
-                # Sleep a while
-                time.sleep(30 * i)
+            if not self.retryPolicy.shouldRetry(r):
+                self.circuitBreaker.record(host, True)
+                return r
 
-        return None
+            self.circuitBreaker.record(host, False)
 
-    @staticmethod
-    def post(url, data=None, json=None, **kwargs):
+            if r is not None:
+                self.count('status-{}'.format(r.status_code))
 
-        if not Network._instance.isEnabled:
-            return None
+            if i + 1 == retries:
+                break
 
-        try:
-            return requests.post(url, data=data, json=json, **kwargs)
-        except Exception as e:
-            print('Error to post', url, ':', e)
+            delay = self.retryPolicy.getDelay(i, r)
+
+            if time.monotonic() - startTime + delay > self.retryPolicy.deadline:
+                self.count('deadlines')
+                break
+
+            if r is not None:
+                r.close()
 
-        return None
+            self.count('retries')
+
+            # Sleep a while
+            time.sleep(delay)
+
+        self.count('failures')
+
+        return r
 
     @staticmethod
-    def getUrl(url, params=None, headers=None, retries=1):
+    def get(url, params=None, retries=None, **kwargs):
+        return Network.getInstance().request('GET', url, retries, params=params, **kwargs)
 
-        if Network._instance is None:
-            Network._instance = Network()
+    @staticmethod
+    def post(url, data=None, json=None, retries=None, **kwargs):
+        return Network.getInstance().request('POST', url, retries, data=data, json=json, **kwargs)
+
+    # Call function with every item in at most concurrency threads, and
+    # return the results in the order of items
+    @staticmethod
+    def batch(function, items, concurrency=None):
 
-        content = Network._instance.getUrlImpl(url, params, headers, retries)
+        if concurrency is None:
+            concurrency = Network.CONCURRENCY
 
-        # Sleep for a while
-        if content is not None:
-            time.sleep(random.random())
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(function, items))
 
-        return content
+    @staticmethod
+    def getUrl(url, params=None, headers=None, retries=None):
+        return Network.getInstance().getUrlImpl(url, params, headers, retries)
 
     def getUrlImpl(self, url, params, headers, retries):
 
@@ -79,22 +309,16 @@ class Network:
         return r.text
 
     @staticmethod
-    def saveUrl(pathPrefix, url, retries=1):
-
-        if Network._instance is None:
-            Network._instance = Network()
+    def registerContentType(contentType, suffix):
+        Network.CONTENT_TYPES[contentType.lower()] = suffix
 
-        path = Network._instance.saveUrlImpl(pathPrefix, url, retries)
-
-        # Sleep for a while
-        if path is not None:
-            time.sleep(random.random())
-
-        return path 
+    @staticmethod
+    def saveUrl(pathPrefix, url, retries=None):
+        return Network.getInstance().saveUrlImpl(pathPrefix, url, retries)
 
     def saveUrlImpl(self, pathPrefix, url, retries):
 
-        r = Network.get(url, retries=retries)
+        r = Network.get(url, retries=retries, stream=True)
         if r is None:
             return None
 
@@ -102,24 +326,30 @@ class Network:
 
         if 'Content-Type' not in r.headers.keys():
             print('Failed to save', url)
+            r.close()
             return None
 
-        contentType = r.headers['Content-Type']
-
-        if 'image/jpeg' == contentType:
-            pathname = '{}.jpg'.format(pathPrefix)
-        elif 'image/png' == contentType:
-            pathname = '{}.png'.format(pathPrefix)
-        elif 'image/gif' == contentType:
-            pathname = '{}.gif'.format(pathPrefix)
-        elif 'audio/mpeg' == contentType:
-            pathname = '{}.mp3'.format(pathPrefix)
-        else:
+        contentType = r.headers['Content-Type'].split(';')[0].strip().lower()
+
+        if contentType not in Network.CONTENT_TYPES.keys():
             print('Not support', contentType, 'for', url)
+            r.close()
             return None
 
-        with open(pathname, 'wb') as fp:
-            fp.write(r.content)
+        pathname = '{}{}'.format(pathPrefix, Network.CONTENT_TYPES[contentType])
+
+        # Never leave a partial file with the final name
+        tempPathname = '{}.part'.format(pathname)
+
+        try:
+            if not self.download(r, url, tempPathname):
+                print('Failed to download', url)
+                return None
+
+            os.replace(tempPathname, pathname)
+
+        finally:
+            remove(tempPathname)
 
         chmod(pathname)
 
@@ -127,3 +357,66 @@ class Network:
 
         return pathname
 
+    @staticmethod
+    def getExpectedSize(r):
+
+        # The length is of the encoded content
+        if 'Content-Encoding' in r.headers.keys():
+            return None
+
+        try:
+            return int(r.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return None
+
+    # Write the response in chunks, and continue it with a range request
+    # if the connection breaks in the middle.
+    def download(self, r, url, pathname):
+
+        expectedSize = Network.getExpectedSize(r)
+        size = 0
+
+        with open(pathname, 'wb') as fp:
+
+            for i in range(Network.RESUME_TIMES + 1):
+
+                try:
+                    for chunk in r.iter_content(chunk_size=Network.CHUNK_SIZE):
+                        fp.write(chunk)
+                        size += len(chunk)
+
+                    if expectedSize is None or size == expectedSize:
+                        return True
+
+                    print('Incomplete', url, ':', size, '!=', expectedSize)
+
+                except requests.RequestException as e:
+                    print('Error to download', url, ':', e)
+
+                finally:
+                    r.close()
+
+                if i == Network.RESUME_TIMES:
+                    break
+
+                r = Network.get(url, headers={'Range': 'bytes={}-'.format(size)}, stream=True)
+                if r is None:
+                    break
+
+                if 206 == r.status_code:
+                    continue
+
+                if 200 == r.status_code:
+                    # Range is ignored, start it over
+                    expectedSize = Network.getExpectedSize(r)
+                    size = 0
+
+                    fp.seek(0)
+                    fp.truncate()
+                    continue
+
+                print('Failed to resume', url, ':', r.status_code)
+                r.close()
+                break
+
+        return False
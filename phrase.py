@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import functools
+import json
+import multiprocessing
 import os
 import re
 import sys
+import threading
 import time
 import traceback
 
 from datetime import datetime
 from tts import LocalTts as Tts
-from utils import remove, reprDict, runCommand, getch, getchar, getPathnames, getProperty, prGreen, prRed, prYellow, prLightPurple, prPurple, prCyan, prLightGray, prBlack, stdinReadline
+from utils import getMd5, remove, reprDict, runCommand, getch, getchar, getPathnames, getProperty, prGreen, prRed, prYellow, prLightPurple, prPurple, prCyan, prLightGray, prBlack, stdinReadline
 
 def getNumber(pathname):
 
@@ -37,6 +41,95 @@ def getNumbers(pathname):
 
     return numbers
 
+# Opt-in counts of matches, bytes rewritten and seconds of every rule in a
+# run. Only a match which changes the string is counted, so a rule that never
+# fires is found dead. Rules matched together in one pass share its time,
+# which is recorded under the name of the pass.
+class RuleProfiler:
+
+    _instance = None
+
+    def __init__(self):
+        self.records = dict()
+
+    @staticmethod
+    def enable():
+
+        if RuleProfiler._instance is None:
+            RuleProfiler._instance = RuleProfiler()
+
+        return RuleProfiler._instance
+
+    # None unless it is enabled
+    @staticmethod
+    def get():
+        return RuleProfiler._instance
+
+    @staticmethod
+    def run(name, function, *args):
+
+        profiler = RuleProfiler._instance
+        if profiler is None:
+            return function(*args)
+
+        startTime = time.perf_counter()
+
+        try:
+            return function(*args)
+        finally:
+            profiler.getRecord(name)['seconds'] += time.perf_counter() - startTime
+
+    def getRecord(self, name):
+
+        record = self.records.get(name)
+
+        if record is None:
+            record = {'count': 0, 'bytes': 0, 'seconds': 0.0}
+            self.records[name] = record
+
+        return record
+
+    def addMatch(self, name, size):
+
+        record = self.getRecord(name)
+
+        record['count'] += 1
+        record['bytes'] += size
+
+    # Return the records and start over, see refineFile
+    def collect(self):
+
+        records = self.records
+        self.records = dict()
+
+        return records
+
+    def merge(self, records):
+
+        for name, other in records.items():
+
+            record = self.getRecord(name)
+
+            for key in record.keys():
+                record[key] += other[key]
+
+    def dump(self, isJson=False):
+
+        if isJson:
+            print(json.dumps({'profile': self.records}, sort_keys=True))
+            return
+
+        names = sorted(self.records.keys(),
+                key=lambda name: (-self.records[name]['seconds'], -self.records[name]['count'], name))
+
+        prCyan('{:32} {:>10} {:>10} {:>12}'.format('Rule', 'Count', 'Bytes', 'Time(ms)'))
+
+        for name in names:
+            record = self.records[name]
+            prCyan('{:32} {:10} {:10} {:12.3f}'.format(
+                name, record['count'], record['bytes'], record['seconds'] * 1000))
+
+
 class BaseExpression:
 
     REPLACE_EXPRESSION_DICT = {
@@ -52,6 +145,12 @@ class BaseExpression:
         },
     }
 
+    # Both rules of REPLACE_EXPRESSION_DICT in one pattern, the dots follow a
+    # word if the group en is matched
+    REPLACE_REGEX = r'(?P<en>[a-zA-Z0-9\']+)?(?P<dots>[ \t]*\.\.[.]*[ \t]*)'
+
+    # Rules with an anchor are skipped if the line has no such character,
+    # and the others are replaced in one pass, see compile()
     EXPRESSION_DICT = {
         'single-dot': {
             'regex': r'([·]+)',
@@ -69,31 +168,66 @@ class BaseExpression:
             'regex': r'\(([^\)]+)$',
             'exp': '({})',
             'strip': True,
+            'anchor': '(',
         },
         'parenthesis-2': {
             'regex': r'\(([^\)]+)\)',
             'exp': '({})',
             'strip': True,
+            'anchor': '(',
         },
         'square-brackets': {
             'regex': r'\[([^\]]+)$',
             'exp': '[{}]',
             'strip': True,
+            'anchor': '[',
         },
         'square-brackets-2': {
             'regex': r'\[([^\]]+)\]',
             'exp': '[{}]',
             'strip': True,
+            'anchor': '[',
         },
     }
 
+    REPLACE_PATTERN = None
+    CHARACTER_PATTERN = None
+
+    # Compile every regex once, and join the rules without anchors, which
+    # replace runs of a character and never overlap, into one alternation
+    @staticmethod
+    def compile():
+
+        for expressionDict in [BaseExpression.REPLACE_EXPRESSION_DICT, BaseExpression.EXPRESSION_DICT]:
+            for key, expression in expressionDict.items():
+                expression['name'] = key
+                expression['pattern'] = re.compile(expression['regex'], re.MULTILINE)
+
+        BaseExpression.REPLACE_PATTERN = re.compile(BaseExpression.REPLACE_REGEX, re.MULTILINE)
+
+        alternatives = []
+
+        for key, expression in BaseExpression.EXPRESSION_DICT.items():
+            if 'anchor' not in expression.keys():
+                alternatives.append('(?P<{}>{})'.format(key.replace('-', '_'), expression['regex']))
+
+        BaseExpression.CHARACTER_PATTERN = re.compile('|'.join(alternatives), re.MULTILINE)
+
+    @staticmethod
+    def getPattern(regex):
+
+        if isinstance(regex, str):
+            return re.compile(regex, re.MULTILINE)
+
+        return regex
+
     # Return a list of positions
     @staticmethod
     def find(string, regex):
 
         positions = []
 
-        matches = re.finditer(regex, string, re.MULTILINE)
+        matches = BaseExpression.getPattern(regex).finditer(string)
 
         for matchNum, match in enumerate(matches, start=1):
 
@@ -117,7 +251,7 @@ class BaseExpression:
         for key in expressionDict.keys():
             expression = expressionDict[key]
 
-            positions = BaseExpression.find(string, expression['regex'])
+            positions = BaseExpression.find(string, expression.get('pattern', expression['regex']))
             if not positions:
                 continue
 
@@ -139,7 +273,7 @@ class BaseExpression:
         for key in expressionDict.keys():
             expression = expressionDict[key]
 
-            positions = BaseExpression.find(dest, expression['regex'])
+            positions = BaseExpression.find(dest, expression.get('pattern', expression['regex']))
             if not positions:
                 continue
 
@@ -164,13 +298,15 @@ class BaseExpression:
     @staticmethod
     def refine(string, expression):
 
-        regex = expression['regex']
+        pattern = expression.get('pattern', expression['regex'])
         exp = expression['exp']
 
+        profiler = RuleProfiler.get()
+
         dest = None
         lastEnd = 0
 
-        matches = re.finditer(regex, string, re.MULTILINE)
+        matches = BaseExpression.getPattern(pattern).finditer(string)
         for matchNum, match in enumerate(matches, start=1):
             groupNum = len(match.groups()) 
 
@@ -189,6 +325,9 @@ class BaseExpression:
 
             content = exp.format(content)
 
+            if profiler is not None and content != match.group(0):
+                profiler.addMatch(expression.get('name', expression['regex']), match.end() - match.start())
+
             dest += string[lastEnd:match.start()] + content
             lastEnd = match.end()
 
@@ -217,117 +356,311 @@ class BaseExpression:
 
         return dest
 
+    # Same as replaceall with REPLACE_EXPRESSION_DICT: the dots after words
+    # are replaced if there are any, otherwise all the dots are
+    @staticmethod
+    def replaceDots(string):
+
+        if '..' not in string:
+            return string
+
+        matches = list(BaseExpression.REPLACE_PATTERN.finditer(string))
+
+        key = 'multiple-dot'
+        for match in matches:
+            if match.start('en') >= 0:
+                key = 'en-multiple-dot'
+                break
+
+        exp = BaseExpression.REPLACE_EXPRESSION_DICT[key]['exp']
+
+        profiler = RuleProfiler.get()
+
+        parts = []
+        lastEnd = 0
+
+        for match in matches:
+
+            if key == 'en-multiple-dot' and match.start('en') < 0:
+                continue
+
+            if profiler is not None and exp != match.group('dots'):
+                profiler.addMatch(key, match.end('dots') - match.start('dots'))
+
+            parts.append(string[lastEnd:match.start('dots')])
+            parts.append(exp)
+
+            lastEnd = match.end('dots')
+
+        parts.append(string[lastEnd:])
+
+        return ''.join(parts)
+
+    @staticmethod
+    def replaceCharacters(match):
+
+        key = match.lastgroup.replace('_', '-')
+        exp = BaseExpression.EXPRESSION_DICT[key]['exp']
+
+        profiler = RuleProfiler.get()
+        if profiler is not None and exp != match.group(0):
+            profiler.addMatch(key, match.end() - match.start())
+
+        return exp
+
     @staticmethod
     def replaceallWithBaseExpression(string):
 
-        dest = BaseExpression.replaceall(string, BaseExpression.REPLACE_EXPRESSION_DICT)
-        dest = BaseExpression.refineall(dest, BaseExpression.EXPRESSION_DICT)
+        dest = RuleProfiler.run('pass dots', BaseExpression.replaceDots, string)
+        dest = RuleProfiler.run('pass characters', BaseExpression.CHARACTER_PATTERN.sub,
+                BaseExpression.replaceCharacters, dest)
+
+        for key, expression in BaseExpression.EXPRESSION_DICT.items():
+            if 'anchor' in expression.keys() and expression['anchor'] in dest:
+                dest = RuleProfiler.run(key, BaseExpression.refine, dest, expression)
 
         return dest
 
-class Category:
+# Build a regex matching any of the strings from a trie of them, so the
+# longer one is tried first and every character is examined only once
+def getTrieRegex(strings):
 
-    NOUN_REGEX = r'[ \t]([nm][,\.]*)[^a-zA-Z]+'
-    VERB_REGEX = r'[ \t]([vuw][,\.]*)[^a-zA-Z]+'
-    VI_REGEX = r'[ \t]([vuw]i[,\.]*)[^a-zA-Z]+'
-    VT_REGEX = r'[ \t]([vuw]t[,\.]*)[^a-zA-Z]+'
-    ADJ_REGEX = r'[ \t](ad[ij:;][,\.]*)[^a-zA-Z]+'
-    ADV_REGEX = r'[ \t](ad[vyu][,\.]*)[^a-zA-Z]+'
-    PREP_REGEX = r'[ \t](prep[,\.]*)[^a-zA-Z]+'
-    CONJ_REGEX = r'[ \t](conj[,\.]*)[^a-zA-Z]+'
-    PRON_REGEX = r'[ \t](pron[,\.]*)[^a-zA-Z]+'
-    DEB_REGEX = r'[ \t](deb[,\.]*)[^a-zA-Z]+'
-    ABBR_REGEX = r'[ \t](abbr[,\.]*)[^a-zA-Z]+'
-    AUX_REGEX = r'[ \t](aux[,\.]*)[^a-zA-Z]+'
-    NUM_REGEX = r'[ \t](num[,\.]*)[^a-zA-Z]+'
-    ART_REGEX = r'[ \t](art[,\.]+)[^a-zA-Z]+'
-
-    CATEGORY_DICT = {
-        'noun': {
-            'regex': NOUN_REGEX,
-            'exp': 'n.'
-        },
-        'verb': {
-            'regex': VERB_REGEX,
-            'exp': 'v.'
-        },
-        'vi': {
-            'regex': VI_REGEX,
-            'exp': 'vi.'
-        },
-        'vt': {
-            'regex': VT_REGEX,
-            'exp': 'vt.'
-        },
-        'adjective': {
-            'regex': ADJ_REGEX,
-            'exp': 'adj.'
-        },
-        'adv': {
-            'regex': ADV_REGEX,
-            'exp': 'adv.'
-        },
-        'prep': {
-            'regex': PREP_REGEX,
-            'exp': 'prep.'
-        },
-        'conj': {
-            'regex': CONJ_REGEX,
-            'exp': 'conj.'
-        },
-        'pron': {
-            'regex': PRON_REGEX,
-            'exp': 'pron.'
-        },
-        'deb': {
-            'regex': DEB_REGEX,
-            'exp': 'deb.'
-        },
-        'abbr': {
-            'regex': ABBR_REGEX,
-            'exp': 'abbr.'
-        },
-        'aux': {
-            'regex': AUX_REGEX,
-            'exp': 'aux.'
-        },
-        'num': {
-            'regex': NUM_REGEX,
-            'exp': 'num.'
-        },
-        'art': {
-            'regex': ART_REGEX,
-            'exp': 'art.'
-        },
-    }
+    trie = dict()
+
+    for string in strings:
+        node = trie
+        for ch in string:
+            node = node.setdefault(ch, dict())
+
+        node[''] = None  # The end
+
+    def getRegex(node):
+
+        branches = [re.escape(ch) + getRegex(child)
+                    for ch, child in sorted(node.items()) if ch != '']
+
+        if len(branches) == 0:
+            return ''
+
+        if len(branches) == 1 and '' not in node.keys():
+            return branches[0]
+
+        regex = '(?:{})'.format('|'.join(branches))
+
+        if '' in node.keys():
+            regex += '?'
+
+        return regex
+
+    return getRegex(trie)
+
+
+# OCR misreadings of categories, one "misreading category" per line of
+# templates/phrases.txt and of an optional file of the user, which overrides
+# the former. They are matched together by one regex, and the files are
+# loaded again once they are changed.
+class Corrections:
+
+    DEFAULT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'templates', 'phrases.txt')
+    CHECK_INTERVAL = 2  # seconds
+
+    # A misreading is a word of its own, with some dots or commas after it
+    REGEX = r'[ \t](?P<content>(?P<misreading>{})[,\.]*)(?=(?P<tail>[^a-zA-Z]+))'
+
+    _instance = None
+
+    def __init__(self, pathnames):
+
+        self.pathnames = pathnames
+
+        self.mtimes = None
+        self.checkTime = time.monotonic()
+
+        # (table, pattern), replaced together
+        self.rules = (dict(), None)
+
+        self.mutex = threading.Lock()
+
+        self.load()
+
+    @staticmethod
+    def init(pathname=None):
+
+        pathnames = [Corrections.DEFAULT_PATH]
+        if pathname:
+            pathnames.append(os.path.realpath(pathname))
+
+        Corrections._instance = Corrections(pathnames)
+
+        return Corrections._instance
+
+    @staticmethod
+    def get():
+
+        if Corrections._instance is None:
+            Corrections.init()
+
+        return Corrections._instance
+
+    def getMtimes(self):
+
+        mtimes = []
+
+        for pathname in self.pathnames:
+            try:
+                mtimes.append(os.stat(pathname).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+
+        return mtimes
+
+    def load(self):
+
+        with self.mutex:
+
+            self.mtimes = self.getMtimes()
+
+            table = dict()
+
+            for pathname in self.pathnames:
+
+                if not os.path.exists(pathname):
+                    continue
+
+                with open(pathname) as fp:
+                    lines = fp.read().splitlines()
+
+                for line in lines:
+
+                    line = line.strip()
+                    if len(line) == 0 or '#' == line[0]:
+                        continue
+
+                    fields = line.rsplit(None, 1)
+                    if len(fields) < 2:
+                        print('Invalid correction in', pathname, ':', line)
+                        continue
+
+                    table[fields[0]] = fields[1]
+
+            pattern = None
+            if len(table) > 0:
+                pattern = re.compile(Corrections.REGEX.format(getTrieRegex(table.keys())), re.MULTILINE)
+
+            self.rules = (table, pattern)
+
+            Sentence.clearCache()
+
+    # Load the files again if any of them is changed, at most once in
+    # CHECK_INTERVAL seconds
+    def check(self):
+
+        now = time.monotonic()
+        if now - self.checkTime < Corrections.CHECK_INTERVAL:
+            return
+
+        self.checkTime = now
+
+        if self.getMtimes() != self.mtimes:
+            self.load()
+
+    # Return a list of (category, start, end, misreading) in one pass. A match consumes
+    # its tail only for the misreadings of the same category, as it did when
+    # every category was found by a regex of its own.
+    def scan(self, string):
+
+        self.check()
+
+        table, pattern = self.rules
+
+        founds = []
+
+        if pattern is None:
+            return founds
+
+        lastEnds = dict()
+
+        for match in pattern.finditer(string):
+
+            category = table[match.group('misreading')]
+
+            if match.start() < lastEnds.get(category, 0):
+                continue
+
+            lastEnds[category] = match.end('tail')
+
+            founds.append((category, match.start('content'), match.end('content'), match.group('misreading')))
+
+        return founds
+
+
+class Category:
 
     @staticmethod
     def findall(string):
-        return BaseExpression.findall(string, Category.CATEGORY_DICT)
+
+        # Add a blank in front of the line
+        founds = RuleProfiler.run('pass corrections (find)', Corrections.get().scan, ' ' + string)
+
+        if len(founds) == 0:
+            return None
+
+        return sorted([(start - 1, end - 1) for category, start, end, misreading in founds])
 
     @staticmethod
     def replaceall(string):
 
         # Add blanks in front of and end of the line
         dest = ' ' + string + ' '
-        dest = BaseExpression.replaceall(dest, Category.CATEGORY_DICT)
-        dest = dest[1:-1]  # remove the blanks
+
+        parts = []
+        lastEnd = 0
+
+        profiler = RuleProfiler.get()
+
+        for category, start, end, misreading in RuleProfiler.run('pass corrections', Corrections.get().scan, dest):
+
+            if profiler is not None and category != dest[start:end]:
+                profiler.addMatch('correction {}'.format(misreading), end - start)
+
+            parts.append(dest[lastEnd:start])
+            parts.append(category)
+
+            lastEnd = end
+
+        parts.append(dest[lastEnd:])
+
+        dest = ''.join(parts)[1:-1]  # remove the blanks
 
         dest = BaseExpression.replaceallWithBaseExpression(dest)
 
         return dest
 
 
+BaseExpression.compile()
+
+
 class Phrase:
 
     REGEXES = [r"\([a-zA-Z0-9']+\.*\)",
                r"[a-zA-Z0-9']+",
                r'[ ,\.%$\-]+']
 
+    # The range continued from the first token found by any of REGEXES. It
+    # is the same as findContinuousRange of all lanes, but in one search: the
+    # matches inside a parenthesis never reach beyond it, and a lane never
+    # continues itself, which only happens to two parentheses in a row.
+    RANGE_PATTERN = re.compile(r"(?:{0}|{1}|{2})(?:(?<!\)){0}|{1}|{2})*".format(*REGEXES), re.MULTILINE)
+
     @staticmethod
     def find(string):
-        lanes = Phrase.multiFindAll(Phrase.REGEXES, string)
-        return Phrase.findContinuousRange(lanes)
+
+        match = Phrase.RANGE_PATTERN.search(string)
+
+        if match is None:
+            return 0, 0
+
+        return match.span()
 
     @staticmethod
     def findall(regex, string):
@@ -464,10 +797,49 @@ class Explanation:
 
 class Sentence:
 
-    # Find the first one
+    CACHE_SIZE = 16 * 1024  # lines
+
+    # Find the first one. Pages repeat the same headers and tags many times,
+    # so the results are kept for the lines seen lately.
     @staticmethod
     def refine(src):
 
+        # A reload of the corrections clears the cache
+        Corrections.get().check()
+
+        if RuleProfiler.get() is not None:
+            # Measure the rules rather than the cache
+            sentence = Sentence.refineLine.__wrapped__(src)
+        else:
+            sentence = Sentence.refineLine(src)
+
+        if sentence is None:
+            return None
+
+        # Never share the cached one
+        return dict(sentence, group=list(sentence['group']))
+
+    @staticmethod
+    def getCacheInfo():
+
+        info = Sentence.refineLine.cache_info()
+
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'max-size': info.maxsize,
+        }
+
+    # Called once the rules are changed
+    @staticmethod
+    def clearCache():
+        Sentence.refineLine.cache_clear()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=CACHE_SIZE)
+    def refineLine(src):
+
         if len(src) == 0:
             return None
 
@@ -489,7 +861,7 @@ class Sentence:
             sentence['group'] = [dest[:start], dest[start:]]
             return sentence
 
-        position = Explanation.find(dest)
+        position = RuleProfiler.run('pass explanation', Explanation.find, dest)
         if position == 0:
             return sentence
 
@@ -502,57 +874,147 @@ class Sentence:
         return sentence
 
 
+# Sentences flow through generators: lines of a file -> Sentence.refine ->
+# the items of the group -> a sink, so a file of any size is refined in
+# constant memory. read() keeps the whole group as a list.
 class SentenceGroup:
 
     def reset(self):
         self.group = []
 
-    def read(self, pathname):
-
-        self.reset()
+    @staticmethod
+    def readLines(pathname):
 
         with open(pathname) as fp:
-            lines = fp.read().splitlines()
+            for line in fp:
+                # The same lines as splitlines() of the whole content
+                yield from line.splitlines()
 
-            for line in lines:
-                sentence = Sentence.refine(line)
-                if not sentence:
-                    continue
+    @staticmethod
+    def refineLines(lines, stats=None):
 
-                self.extend(sentence)
+        for line in lines:
+            sentence = Sentence.refine(line)
+            if not sentence:
+                continue
 
-        return self.group
+            if stats is not None:
+                stats['lines'] += 1
 
-    def extend(self, sentence):
+                if sentence['changed']:
+                    stats['changed'] += 1
+
+                if len(sentence['group']) > 1:
+                    stats['split'] += 1
 
-        def shouldExtendExplanation(sentence, group):
-            length = len(group)
+            yield sentence
 
-            if length == 0 or length % 2 == 1:
-                return False
+    @staticmethod
+    def shouldExtendExplanation(sentence, length):
+
+        if length == 0 or length % 2 == 1:
+            return False
+
+        if not sentence['exist-explanation']:
+            return False
+
+        if len(sentence['group']) > 1:
+            return False
+
+        return True
 
-            if not sentence['exist-explanation']:
-                return False
+    @staticmethod
+    def shouldCombine(sentence, length):
+
+        if length % 2 == 0:
+            return False
+
+        if len(sentence['group']) < 2:
+            return False
 
-            if len(sentence['group']) > 1:
-                return False
+        return True
+
+    # Yield the items of the group. The last one is held until the next
+    # sentence, which may be an explanation continuing it.
+    @staticmethod
+    def stream(sentences, stats=None):
+
+        length = 0
+        last = None
+
+        for sentence in sentences:
+
+            if SentenceGroup.shouldExtendExplanation(sentence, length):
+                last += sentence['group'][0]
+
+                if stats is not None:
+                    stats['merged'] += 1
+
+                continue
+
+            if SentenceGroup.shouldCombine(sentence, length):
+                items = [''.join(sentence['group'])]
+
+                if stats is not None:
+                    stats['merged'] += 1
+            else:
+                items = sentence['group']
 
-            return True
+            for item in items:
 
-        def shouldCombine(sentence, group):
-            if len(group) % 2 == 0:
-                return False
+                if last is not None:
+                    yield last
 
-            if len(sentence['group']) < 2:
-                return False
+                last = item
+                length += 1
 
-            return True
+        if last is not None:
+            yield last
 
-        if shouldExtendExplanation(sentence, self.group):
+    # Counts of lines are added into stats if it is given, see refineFile
+    @staticmethod
+    def iterate(pathname, stats=None):
+        return SentenceGroup.stream(
+                SentenceGroup.refineLines(SentenceGroup.readLines(pathname), stats), stats)
+
+    # Write the items one per line as they come, and move the file into
+    # place once it is complete
+    @staticmethod
+    def write(items, pathname):
+
+        tempPathname = '{}.tmp'.format(pathname)
+
+        count = 0
+
+        try:
+            with open(tempPathname, 'w') as fp:
+                for item in items:
+                    fp.write(item)
+                    fp.write('\n')
+                    count += 1
+
+            os.replace(tempPathname, pathname)
+
+        finally:
+            remove(tempPathname)
+
+        return count
+
+    def read(self, pathname):
+
+        self.reset()
+
+        self.group = list(SentenceGroup.iterate(pathname))
+
+        return self.group
+
+    def extend(self, sentence):
+
+        if SentenceGroup.shouldExtendExplanation(sentence, len(self.group)):
             self.group[len(self.group) - 1] += sentence['group'][0]
             return
 
-        if shouldCombine(sentence, self.group):
+        if SentenceGroup.shouldCombine(sentence, len(self.group)):
             self.group.append(''.join(sentence['group']))
             return
 
@@ -562,30 +1024,125 @@ class SentenceGroup:
 
         prBlack('Refining {}'.format(pathname))
 
-        with open(pathname) as fp:
-            lines = fp.read().splitlines()
+        for line in SentenceGroup.readLines(pathname):
 
-            for line in lines:
-                sentence = Sentence.refine(line)
-                if not sentence:
-                    continue
+            sentence = Sentence.refine(line)
+            if not sentence:
+                continue
 
-                if sentence['changed']:
-                    prCyan('{}'.format(line))
-                    group = sentence['group']
-                    if len(group) == 1:
-                        prRed('\t{}'.format(group[0]))
-                    else:
-                        prRed('\t{:40}\t{:40}'.format(group[0], group[1]))
+            if sentence['changed']:
+                prCyan('{}'.format(line))
+                group = sentence['group']
+                if len(group) == 1:
+                    prRed('\t{}'.format(group[0]))
                 else:
-                    prGreen('{}'.format(line))
+                    prRed('\t{:40}\t{:40}'.format(group[0], group[1]))
+            else:
+                prGreen('{}'.format(line))
 
 
-def run(name, pathname):
+# Run in a worker process, and return the summary of a file
+def refineFile(pathname):
+
+    stats = {
+        'pathname': pathname,
+        'lines': 0,
+        'changed': 0,
+        'split': 0,
+        'merged': 0,
+    }
+
+    try:
+        group = list(SentenceGroup.iterate(pathname, stats))
+
+        stats['items'] = len(group)
+        stats['md5code'] = getMd5('\n'.join(group))
+
+    except Exception as e:
+        stats['error'] = '{}'.format(e)
+
+    profiler = RuleProfiler.get()
+    if profiler is not None:
+        stats['profile'] = profiler.collect()
+
+    return stats
+
+
+def enableProfiler():
+    RuleProfiler.enable()
+
+
+# Print a JSON line for every file, then one of the totals, and the rules if
+# isProfiling, in a JSON line if isJson or in a table
+def refineFiles(pathnames, processes=None, isProfiling=False, isJson=False):
+
+    totals = {
+        'files': len(pathnames),
+        'lines': 0,
+        'changed': 0,
+        'split': 0,
+        'merged': 0,
+        'errors': 0,
+    }
+
+    startTime = time.time()
+
+    profiler = None
+    initializer = None
+
+    if isProfiling:
+        profiler = RuleProfiler.enable()
+        initializer = enableProfiler
+
+    with multiprocessing.Pool(processes, initializer) as pool:
+
+        for stats in pool.imap(refineFile, pathnames):
+
+            if 'profile' in stats.keys():
+                profiler.merge(stats.pop('profile'))
+
+            print(json.dumps(stats, ensure_ascii=False), flush=True)
+
+            if 'error' in stats.keys():
+                totals['errors'] += 1
+
+            for key in ['lines', 'changed', 'split', 'merged']:
+                totals[key] += stats[key]
+
+    totals['seconds'] = round(time.time() - startTime, 3)
+
+    print(json.dumps({'totals': totals}))
+
+    if profiler is not None:
+        profiler.dump(isJson)
+
+    return totals
+
+
+def runBatch(name, dirname, processes=None, isProfiling=False, isJson=False):
+
+    try:
+        pathnames = getPathnames(dirname, '.txt')
+        refineFiles(pathnames, processes, isProfiling, isJson)
+
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        traceback.print_exc()
+    finally:
+        pass
+
+
+def run(name, pathname, outputPath=None):
 
     try:
         prBlack('Now: {}'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
 
+        if outputPath:
+            count = SentenceGroup.write(SentenceGroup.iterate(pathname), outputPath)
+            prGreen('Refined {} into {} lines of {}'.format(pathname, count, outputPath))
+            return
+
         group = SentenceGroup()
         group.test(pathname)
 
@@ -608,8 +1165,16 @@ def run(name, pathname):
 
 def main(argv):
 
+    # --profile prints a table of the rules, and --profile=json a JSON line
+    profile = None
+    for arg in argv[1:]:
+        if arg.startswith('--profile'):
+            profile = arg
+
+    argv = [arg for arg in argv if not arg.startswith('--profile')]
+
     if len(argv) < 2:
-        print('Usage:\n\t', argv[0], 'PATH-NAME\n')
+        print('Usage:\n\t', argv[0], '[--profile[=json]] PATH-NAME [OUTPUT-PATH-NAME]\n\t', argv[0], '[--profile[=json]] DIRECTORY [PROCESS-NUMBER]\n')
         return
 
     os.environ['TZ'] = 'Asia/Shanghai'
@@ -618,7 +1183,26 @@ def main(argv):
     name = os.path.basename(argv[0])[:-3]  # Remove ".py"
     pathname = os.path.realpath(argv[1])
 
-    run(name, pathname)
+    if os.path.isdir(pathname):
+
+        processes = None
+        if len(argv) > 2:
+            processes = int(argv[2])
+
+        runBatch(name, pathname, processes, profile is not None, profile == '--profile=json')
+        return
+
+    outputPath = None
+    if len(argv) > 2:
+        outputPath = os.path.realpath(argv[2])
+
+    if profile is not None:
+        RuleProfiler.enable()
+
+    run(name, pathname, outputPath)
+
+    if profile is not None:
+        RuleProfiler.get().dump(profile == '--profile=json')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import atexit
+import os
+import select
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import wave
+
+from utils import remove, runCommand
+
+try:
+    import simpleaudio
+except ImportError:
+    simpleaudio = None
+
+
+# Parameters of PCM frames: (nchannels, sampwidth, framerate)
+def getPcmParams(fp):
+    return (fp.getnchannels(), fp.getsampwidth(), fp.getframerate())
+
+
+# Return (params, frames) of a wave file, or None if it is not one
+def decodeWave(pathname):
+
+    try:
+        with wave.open(pathname, 'rb') as fp:
+            return getPcmParams(fp), fp.readframes(fp.getnframes())
+    except (wave.Error, EOFError):
+        return None
+
+
+def decode(pathname):
+
+    result = decodeWave(pathname)
+    if result is not None:
+        return result
+
+    # Not a wave file, let mplayer decode it
+    fd, wavePathname = tempfile.mkstemp(suffix='.wav')
+    os.close(fd)
+
+    try:
+        cmd = 'mplayer -really-quiet -vo null -vc null -ao pcm:fast:file={} {}'.format(
+            shlex.quote(wavePathname), shlex.quote(pathname))
+        runCommand(cmd)
+
+        with wave.open(wavePathname, 'rb') as fp:
+            return getPcmParams(fp), fp.readframes(fp.getnframes())
+    finally:
+        remove(wavePathname)
+
+
+def getSilence(params, seconds):
+
+    nchannels, sampwidth, framerate = params
+
+    # 8-bit samples are unsigned
+    sample = b'\x80' if sampwidth == 1 else b'\0' * sampwidth
+
+    return sample * nchannels * int(framerate * seconds)
+
+
+def savePcm(pathname, params, frames):
+
+    nchannels, sampwidth, framerate = params
+
+    with wave.open(pathname, 'wb') as fp:
+        fp.setnchannels(nchannels)
+        fp.setsampwidth(sampwidth)
+        fp.setframerate(framerate)
+        fp.writeframes(frames)
+
+
+class Player:
+
+    _instance = None
+
+    @staticmethod
+    def create(name=None):
+
+        if name is None:
+            if simpleaudio is not None:
+                name = 'pcm'
+            elif shutil.which('mplayer') is not None:
+                name = 'pipe'
+            else:
+                name = 'mplayer'
+
+        if 'pcm' == name:
+            if simpleaudio is not None:
+                return PcmPlayer()
+
+            print('Not support pcm player without simpleaudio')
+            name = 'pipe'
+
+        if 'pipe' == name:
+            return PipePlayer()
+
+        if 'mplayer' != name:
+            print('Not support player', name)
+
+        return MplayerPlayer()
+
+    @staticmethod
+    def init(name=None):
+
+        if Player._instance is not None:
+            Player._instance.close()
+
+        Player._instance = Player.create(name)
+
+        return Player._instance
+
+    @staticmethod
+    def get():
+
+        if Player._instance is None:
+            Player._instance = Player.create()
+
+        return Player._instance
+
+    def play(self, pathname, speed=1):
+        raise TypeError('No implement')
+
+    def playPcm(self, params, frames, speed=1):
+
+        fd, pathname = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+
+        try:
+            savePcm(pathname, params, frames)
+            self.play(pathname, speed)
+        finally:
+            remove(pathname)
+
+    # Stop the clip being played, it could be called from other threads
+    def stop(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# One mplayer process per clip
+class MplayerPlayer(Player):
+
+    def __init__(self):
+        self.process = None
+
+    def play(self, pathname, speed=1):
+
+        cmd = ['mplayer', '-really-quiet', '-af', 'scaletempo', '-speed', '{}'.format(speed), pathname]
+
+        try:
+            self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL)
+            self.process.wait()
+        except OSError as e:
+            print('Error to play', pathname, ':', e)
+        finally:
+            self.process = None
+
+    def stop(self):
+
+        process = self.process
+
+        if process is not None and process.poll() is None:
+            process.terminate()
+
+
+# One long-lived mplayer in slave mode, fed with a file per command. The end
+# of a file is reported as "EOF code" in its verbose messages. If nothing is
+# heard for TIMEOUT seconds, it is asked for the position, and it is taken as
+# stuck if it does not answer that it is playing.
+class PipePlayer(Player):
+
+    TIMEOUT = 5  # seconds
+
+    COMMAND = ['mplayer', '-slave', '-idle', '-quiet', '-noconsolecontrols',
+               '-vo', 'null', '-af', 'scaletempo', '-msglevel', 'global=6']
+
+    def __init__(self):
+
+        self.process = None
+        self.fallback = MplayerPlayer()
+
+        self.isPlaying = False
+        self.mutex = threading.Lock()
+
+        atexit.register(self.close)
+
+    def open(self):
+
+        if self.process is not None and self.process.poll() is None:
+            return True
+
+        try:
+            self.process = subprocess.Popen(PipePlayer.COMMAND,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT,
+                                            universal_newlines=True,
+                                            bufsize=1)
+        except OSError as e:
+            print('Error to start mplayer:', e)
+            self.process = None
+
+        return self.process is not None
+
+    def send(self, command):
+
+        self.process.stdin.write('{}\n'.format(command))
+        self.process.stdin.flush()
+
+    # Return True once the file is done, or False if mplayer quits or is stuck
+    def wait(self):
+
+        fd = self.process.stdout.fileno()
+
+        buffer = ''
+        isAsked = False
+
+        while True:
+
+            readables, _, _ = select.select([fd], [], [], PipePlayer.TIMEOUT)
+
+            if len(readables) == 0:
+                if isAsked:
+                    return False
+
+                self.send('get_time_pos')
+                isAsked = True
+                continue
+
+            data = os.read(fd, 4096)
+            if not data:
+                return False  # mplayer quits
+
+            lines = (buffer + data.decode('utf-8', 'replace')).split('\n')
+            buffer = lines.pop()
+
+            for line in lines:
+
+                if line.startswith('EOF code:') or line.startswith('Failed to open'):
+                    return True
+
+                if line.startswith('ANS_TIME_POSITION'):
+                    isAsked = False
+                elif line.startswith('ANS_ERROR'):
+                    return False
+
+    def play(self, pathname, speed=1):
+
+        with self.mutex:
+
+            if not os.path.exists(pathname):
+                print('Not found', pathname)
+                return
+
+            if self.open():
+                try:
+                    self.isPlaying = True
+
+                    self.send('loadfile "{}"'.format(pathname.replace('"', '\\"')))
+                    self.send('speed_set {}'.format(speed))
+
+                    if self.wait():
+                        return
+
+                except (OSError, ValueError) as e:
+                    print('Error to play', pathname, ':', e)
+
+                finally:
+                    self.isPlaying = False
+
+                self.close()
+
+        self.fallback.play(pathname, speed)
+
+    def stop(self):
+
+        if self.isPlaying:
+            try:
+                self.send('stop')
+            except (AttributeError, OSError, ValueError):
+                pass
+
+        self.fallback.stop()
+
+    def close(self):
+
+        process = self.process
+        self.process = None
+
+        if process is None or process.poll() is not None:
+            return
+
+        try:
+            process.stdin.write('quit\n')
+            process.stdin.flush()
+            process.wait(timeout=1)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            process.kill()
+
+
+# Play PCM in the process itself. It could not change the speed but keep the
+# tempo, so other speeds are left to mplayer.
+class PcmPlayer(Player):
+
+    def __init__(self):
+
+        self.playObject = None
+        self.fallback = PipePlayer()
+
+    def play(self, pathname, speed=1):
+
+        if speed != 1:
+            self.fallback.play(pathname, speed)
+            return
+
+        # Others are left to the running mplayer rather than decoded by a new
+        # one every time
+        try:
+            result = decodeWave(pathname)
+        except OSError as e:
+            print('Error to decode', pathname, ':', e)
+            result = None
+
+        if result is None:
+            self.fallback.play(pathname, speed)
+            return
+
+        params, frames = result
+        self.playPcm(params, frames, speed)
+
+    def playPcm(self, params, frames, speed=1):
+
+        if speed != 1:
+            super().playPcm(params, frames, speed)
+            return
+
+        nchannels, sampwidth, framerate = params
+
+        self.playObject = simpleaudio.play_buffer(frames, nchannels, sampwidth, framerate)
+        self.playObject.wait_done()
+        self.playObject = None
+
+    def stop(self):
+
+        playObject = self.playObject
+        if playObject is not None:
+            playObject.stop()
+
+        self.fallback.stop()
+
+    def close(self):
+        self.fallback.close()
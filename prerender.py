@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from cache import AudioCache
+from datetime import datetime
+from tts import LocalTts as Tts
+from utils import getPathnames, getProperty, prGreen, prRed, prYellow
+from word import Word
+
+
+def collectTexts(pathnames):
+
+    texts = []
+    founds = set()
+
+    def append(language, text):
+
+        text = text.strip()
+        if 0 == len(text) or (language, text) in founds:
+            return
+
+        founds.add((language, text))
+        texts.append((language, text))
+
+    for pathname in pathnames:
+
+        with open(pathname) as fp:
+            contents = json.loads(fp.read())['contents-list']
+
+        for content in contents:
+
+            word = Word(None, content)
+
+            append('english', word.english)
+            append('chinese', word.chinese)
+            append('english', word.explanation)
+
+            for sample in word.samples:
+                append('english', sample)
+
+            for letter in word.letters or []:
+                append('english', letter)
+
+    return texts
+
+
+# Run in a worker process: only render the file, the index of the cache is
+# updated by the main process.
+def renderText(cacheDir, language, text):
+
+    tts = Tts()
+    tts.setLanguage(language)
+    tts.switchVoice()
+
+    key, generate = tts.prepare(text)
+
+    prefix = os.path.join(cacheDir, '{}.{}.tmp'.format(key, os.getpid()))
+
+    try:
+        return key, generate(prefix)
+    except Exception as e:
+        print('Error to render', text, ':', e)
+
+    return key, None
+
+
+def renderTask(task):
+    return renderText(*task)
+
+
+def renderTexts(cache, texts, processes=None):
+
+    # Words are said in the first voice of each language, see Word.say
+    ttses = dict()
+    for language in ['english', 'chinese']:
+        tts = Tts()
+        tts.setLanguage(language)
+        tts.switchVoice()
+        ttses[language] = tts
+
+    tasks = []
+
+    for language, text in texts:
+        key, _ = ttses[language].prepare(text)
+
+        if cache.lookup(key) is None:
+            tasks.append((cache.dirname, language, text))
+
+    total = len(texts)
+    skippedCount = total - len(tasks)
+
+    prYellow('{} texts, {} are already rendered'.format(total, skippedCount))
+
+    if len(tasks) == 0:
+        return
+
+    cache.cleanup()
+
+    succeededCount = 0
+    failedCount = 0
+
+    startTime = time.time()
+
+    with multiprocessing.Pool(processes) as pool:
+
+        for key, pathname in pool.imap_unordered(renderTask, tasks):
+
+            if pathname is not None and os.path.exists(pathname) and os.path.getsize(pathname) > 0:
+                cache.add(key, pathname)
+                succeededCount += 1
+            else:
+                failedCount += 1
+
+            doneCount = succeededCount + failedCount
+            elapsed = time.time() - startTime
+
+            print('\033[96m [{}/{}] rendered {}, failed {}, {:.1f} texts/s\033[00m'.format(
+                doneCount + skippedCount, total, succeededCount, failedCount,
+                doneCount / elapsed if elapsed > 0 else 0), end='\r')
+
+    cache.save()
+
+    print('')
+    prGreen('Rendered {}, failed {}, skipped {}'.format(
+        succeededCount, failedCount, skippedCount))
+
+
+def run(name, configFile, processes=None):
+
+    try:
+        prGreen('Now: {}'.format(datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+
+        sourcePath = getProperty(configFile, 'source-path')
+
+        cache = AudioCache.init(getProperty(configFile, 'audio-cache-path'))
+
+        pathnames = getPathnames(sourcePath, '.json')
+        if len(pathnames) == 0:
+            prRed('No lesson is found in {}'.format(sourcePath))
+            return
+
+        texts = collectTexts(pathnames)
+        prGreen('{} lessons are found in {}'.format(len(pathnames), sourcePath))
+
+        renderTexts(cache, texts, processes)
+
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        prRed('Error occurs at {}'.format(
+            datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        traceback.print_exc(file=sys.stdout)
+    finally:
+        pass
+
+
+def main(argv):
+
+    if len(argv) < 2:
+        print('Usage:\n\t', argv[0], 'config-file [PROCESS-NUMBER]\n')
+        return
+
+    os.environ['TZ'] = 'Asia/Shanghai'
+    time.tzset()
+
+    name = os.path.basename(argv[0])[:-3]  # Remove ".py"
+    configFile = os.path.realpath(argv[1])
+
+    processes = None
+    if len(argv) > 2:
+        processes = int(argv[2])
+
+    run(name, configFile, processes)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
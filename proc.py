@@ -5,12 +5,15 @@ import copy
 import hashlib
 import json
 import os
+import queue
 import random
+import select
 import sys
-import time
+import threading
 import traceback
 
 from datetime import datetime
+from speaker import Speaker
 from tts import LocalTts as Tts
 from utils import mkdir, prGreen, prYellow, prLightPurple, prPurple, prCyan, prLightGray, prBlack, getPathnames, playSound, stdinReadline
 from word import Word
@@ -18,6 +21,8 @@ from word import Word
 
 class Procedure:
 
+    POLL_INTERVAL = 0.1  # seconds
+
     def __init__(self, dirname=None, jsonPath=None, jsonContent=None):
 
         if jsonPath is not None:
@@ -38,6 +43,30 @@ class Procedure:
 
         mkdir(self.dirname)
 
+    # Read input while the queued speech is being said and for the timeout
+    # after it is done. Any input drops the rest of the speech.
+    def listen(self, timeout, isStrip=True):
+
+        speaker = Speaker.get()
+        doneEvent = speaker.put(None)
+
+        while not doneEvent.is_set():
+
+            readables, _, _ = select.select([sys.stdin], [], [], Procedure.POLL_INTERVAL)
+
+            if readables:
+                speaker.cancel()
+
+                value = sys.stdin.readline()
+                if isStrip:
+                    value = value.strip()
+
+                return value
+
+        value, _ = stdinReadline(timeout, isStrip=isStrip)
+
+        return value
+
 
 class StudyProcedure(Procedure):
 
@@ -59,40 +88,88 @@ class StudyProcedure(Procedure):
         MAX_NUM = 1
 
         word = Word(self.dirname, content)
+        speaker = Speaker.get()
 
         print('Chinese:\n\t', word.chinese)
         print('Word:\n\t', word.english)
 
         for index in range(MAX_WORD_PLAYING_NUM):
 
-            word.playEnglish()
-            time.sleep(0.5)
+            speaker.say(word.playEnglish)
+            speaker.pause(0.5)
 
-            word.playChinese()
-            time.sleep(0.5)
+            speaker.say(word.playChinese)
+            speaker.pause(0.5)
 
-            word.playLetters()
-            time.sleep(0.5)
+            speaker.say(word.playLetters)
+            speaker.pause(0.5)
 
-        value = stdinReadline(2)
+        value = self.listen(2)
         if 0 != len(value):
             return
 
         print('Explanation:\n\t', word.explanation)
         for index in range(MAX_NUM):
-            word.playExplanation()
+            speaker.say(word.playExplanation)
 
-        value = stdinReadline(2)
+        value = self.listen(2)
         if 0 != len(value):
             return
 
         print('Sample:\n\t', word.getSample())
         for index in range(MAX_NUM):
-            word.playSample()
+            speaker.say(word.playSample)
+
+        speaker.wait()
+
+
+# Render the audio of words into the cache before they are tested
+class Prefetcher(threading.Thread):
+
+    def __init__(self, dirname):
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.running = True
+
+        self.dirname = dirname
+        self.queue = queue.Queue()
+
+        self.prefetchedWords = set()
+
+    def prefetch(self, contents):
+
+        for content in contents:
+            self.queue.put(content)
+
+    def run(self):
+
+        while self.running:
+
+            content = self.queue.get()
+            if content is None:
+                break
+
+            if content['word'] in self.prefetchedWords:
+                continue
+
+            try:
+                Word(self.dirname, content).prefetch()
+                self.prefetchedWords.add(content['word'])
+            except Exception as e:
+                print('Error to prefetch', content['word'], ':', e)
+
+    def quit(self):
+
+        self.running = False
+        self.queue.put(None)
 
 
 class TestProcedure(Procedure):
 
+    PREFETCH_NUM = 3
+
     def __init__(self, dirname=None, jsonPath=None, jsonContent=None):
         super().__init__(dirname, jsonPath, jsonContent)
 
@@ -100,23 +177,37 @@ class TestProcedure(Procedure):
 
         random.seed()
 
+        prefetcher = Prefetcher(self.dirname)
+        prefetcher.start()
+
+        try:
+            self.runRounds(prefetcher)
+        finally:
+            prefetcher.quit()
+
+        self.sayGreeting()
+
+    def runRounds(self, prefetcher):
+
         wholeContents = copy.deepcopy(self.contents)
 
         while len(wholeContents) > 0:
 
+            # The order of a round is decided at first, so the following
+            # words could be prefetched while the current one is tested.
             contents = copy.deepcopy(wholeContents)
+            random.shuffle(contents)
 
-            for num in range(len(contents), 0, -1):
+            for num in range(len(contents)):
 
-                num -= 1
-                index = random.randint(0, num)
+                prefetcher.prefetch(contents[num:num + 1 + TestProcedure.PREFETCH_NUM])
 
                 os.system('clear')
 
                 print('---------------------------------------------------------------')
                 print(len(wholeContents), 'words are left.')
 
-                content = contents.pop(index)
+                content = contents[num]
                 if not self.testWord(content):
                     continue
 
@@ -129,46 +220,45 @@ class TestProcedure(Procedure):
                         print('"', aContent['word'], '" is skipped.')
                         break
 
-        self.sayGreeting()
-
     def testWord(self, content):
 
         word = Word(self.dirname, content)
+        speaker = Speaker.get()
 
         print('Explanation:')
-        word.playExplanation()
+        speaker.say(word.playExplanation)
 
-        value = stdinReadline(5, isStrip=False)
+        value = self.listen(5, isStrip=False)
 
         print('\t', word.explanation)
 
         if 0 == len(value):
-            word.playExplanation()
-            stdinReadline(5)
+            speaker.say(word.playExplanation)
+            self.listen(5)
 
         print('Chinese:')
-        stdinReadline(5)
+        self.listen(5)
 
         print('\t', word.chinese)
-        word.playChinese()
+        speaker.say(word.playChinese)
 
         print('Word:')
-        stdinReadline(5)
+        self.listen(5)
 
         print('\t', word.english)
-        word.playEnglish()
-        time.sleep(0.5)
+        speaker.say(word.playEnglish)
+        speaker.pause(0.5)
 
-        word.playLetters()
-        time.sleep(0.5)
+        speaker.say(word.playLetters)
+        speaker.pause(0.5)
 
         print('Sample:')
         print('\t', word.getSample())
 
-        word.playSample()
+        speaker.say(word.playSample)
 
         print('Press any key except return key to skip "', word.english, '".')
-        value = stdinReadline(10)
+        value = self.listen(10)
 
         return (len(value) > 0)
 
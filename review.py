@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import heapq
+import json
+import os
+import random
+import time
+
+from utils import prYellow, writeAtomically
+
+
+# SM-2 scheduling of items to review, with a queue ordered by due time.
+#
+# Every item has repetitions, an interval in days, an easiness factor and the
+# time it is due. A remembered item is due again 1 day, 6 days and then the
+# last interval times the easiness later, and a forgotten one starts over and
+# is due at once, behind the items which are already due, with its easiness
+# kept. An item is graded once a session, and shown again with repeat() until
+# it is remembered. New items are due
+# at the beginning, in random order. States are kept in a JSON file beside
+# the reviewed one if a pathname is given.
+class ReviewScheduler:
+
+    SUFFIX = '.review.json'
+    VERSION = 1
+
+    DAY = 24 * 60 * 60  # seconds
+
+    EASINESS = 2.5
+    MIN_EASINESS = 1.3
+
+    # Quality of a response, from 0 to 5, it is remembered from 3
+    REMEMBERED = 5
+    FORGOTTEN = 1
+
+    def __init__(self, pathname=None):
+
+        self.pathname = None
+        if pathname is not None:
+            self.pathname = '{}{}'.format(pathname, ReviewScheduler.SUFFIX)
+
+        self.states = dict()
+        self.queue = []
+
+        self.read()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def read(self):
+
+        if self.pathname is None or not os.path.exists(self.pathname):
+            return
+
+        try:
+            with open(self.pathname) as fp:
+                content = json.loads(fp.read())
+        except (OSError, ValueError) as e:
+            prYellow('Failed to read {}: {}'.format(self.pathname, e))
+            return
+
+        if content.get('version') == ReviewScheduler.VERSION:
+            self.states = content['states']
+
+    def save(self):
+
+        if self.pathname is None:
+            return
+
+        content = {
+            'version': ReviewScheduler.VERSION,
+            'states': self.states,
+        }
+
+        writeAtomically(self.pathname, json.dumps(content, ensure_ascii=False, indent=4, sort_keys=True))
+
+    def add(self, key):
+
+        state = self.states.get(key)
+
+        due = 0
+        if state is not None:
+            due = state['due']
+
+        heapq.heappush(self.queue, (due, random.random(), key))
+
+    # Return the key of the item due first, or None if nothing is due
+    def pop(self, now=None):
+
+        if now is None:
+            now = time.time()
+
+        if len(self.queue) == 0 or self.queue[0][0] > now:
+            return None
+
+        _, _, key = heapq.heappop(self.queue)
+        return key
+
+    def getDueCount(self, now=None):
+
+        if now is None:
+            now = time.time()
+
+        return sum(1 for due, _, _ in self.queue if due <= now)
+
+    def getNextDue(self):
+
+        if len(self.queue) == 0:
+            return None
+
+        return self.queue[0][0]
+
+    def review(self, key, quality, now=None):
+
+        if now is None:
+            now = time.time()
+
+        state = self.states.get(key)
+        if state is None:
+            state = {'repetitions': 0, 'interval': 0, 'easiness': ReviewScheduler.EASINESS}
+
+        if quality >= 3:
+            if state['repetitions'] == 0:
+                interval = 1
+            elif state['repetitions'] == 1:
+                interval = 6
+            else:
+                interval = round(state['interval'] * state['easiness'])
+
+            state['repetitions'] += 1
+            state['interval'] = interval
+
+            difference = 5 - quality
+            state['easiness'] = max(ReviewScheduler.MIN_EASINESS,
+                    state['easiness'] + 0.1 - difference * (0.08 + difference * 0.02))
+        else:
+            state['repetitions'] = 0
+            state['interval'] = 0
+
+        state['due'] = now + state['interval'] * ReviewScheduler.DAY
+
+        self.states[key] = state
+
+        heapq.heappush(self.queue, (state['due'], random.random(), key))
+
+    # Show an item again in the session without grading it
+    def repeat(self, key, now=None):
+
+        if now is None:
+            now = time.time()
+
+        heapq.heappush(self.queue, (now, random.random(), key))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import functools
+import queue
+import threading
+import traceback
+
+from player import Player
+
+
+# Say things in a background thread one after another, so the caller could
+# wait for input at the same time. Every item has an event which is set when
+# it is done or dropped; cancel() drops the pending items and stops the one
+# being played. Rendering could not be stopped, so an item put by say() gets
+# its cancel event to check before it starts playing.
+class Speaker(threading.Thread):
+
+    _instance = None
+
+    def __init__(self):
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.running = True
+
+        self.queue = queue.Queue()
+
+        self.cancelEvent = threading.Event()
+        self.mutex = threading.Lock()
+
+    @staticmethod
+    def get():
+
+        if Speaker._instance is None:
+            Speaker._instance = Speaker()
+            Speaker._instance.start()
+
+        return Speaker._instance
+
+    def put(self, function, *args):
+
+        doneEvent = threading.Event()
+
+        with self.mutex:
+            self.queue.put((self.cancelEvent, doneEvent, function, args))
+
+        return doneEvent
+
+    # function is called with cancelEvent, which is set if it is cancelled
+    def say(self, function, *args):
+
+        with self.mutex:
+            cancelEvent = self.cancelEvent
+
+        return self.put(functools.partial(function, cancelEvent=cancelEvent), *args)
+
+    def pause(self, seconds):
+
+        with self.mutex:
+            cancelEvent = self.cancelEvent
+
+        return self.put(cancelEvent.wait, seconds)
+
+    # Wait until all items put before are done
+    def wait(self, timeout=None):
+        return self.put(None).wait(timeout)
+
+    def cancel(self):
+
+        with self.mutex:
+
+            self.cancelEvent.set()
+            self.cancelEvent = threading.Event()
+
+            while True:
+                try:
+                    _, doneEvent, _, _ = self.queue.get_nowait()
+                    doneEvent.set()
+                except queue.Empty:
+                    break
+
+        Player.get().stop()
+
+    def run(self):
+
+        while self.running:
+
+            cancelEvent, doneEvent, function, args = self.queue.get()
+
+            try:
+                if function is not None and not cancelEvent.is_set():
+                    function(*args)
+            except Exception as e:
+                print('Error to say:', e)
+                traceback.print_exc()
+            finally:
+                doneEvent.set()
+
+    def quit(self):
+
+        self.running = False
+        self.cancel()
+
+        self.put(None)
@@ -2,18 +2,25 @@
 # -*- coding:utf-8 -*-
 
 import csv
+import heapq
 import json
+import multiprocessing
 import os
 import random
 import re
 import sys
+import tempfile
 import time
 import traceback
 
+from bundle import SynonymBundle, zstandard
+from cache import AudioCache
 from datetime import datetime
 from phrase import getNumber, getNumbers
+from player import Player
+from review import ReviewScheduler
 from tts import LocalTts as Tts
-from utils import getch, getchar, getPathnames, getProperty, reprDict, prGreen, prRed, prYellow, prLightPurple, prPurple, prCyan, prLightGray, prBlack, stdinReadline
+from utils import getch, getchar, getProperty, insertSorted, mkdir, writeAtomically, prGreen, prRed, prYellow, prLightPurple, prPurple, prCyan, prLightGray, prBlack, stdinReadline
 
 
 class Synonym:
@@ -96,8 +103,16 @@ class Synonym:
 class SynonymChapter:
 
     def __init__(self):
-        self.tts = Tts()
-        self.tts.setLanguage('english')
+        self.tts = None
+
+    # Only studying says words, never create it for exporting
+    def getTts(self):
+
+        if self.tts is None:
+            self.tts = Tts()
+            self.tts.setLanguage('english')
+
+        return self.tts
 
     def getPositions(self, configsPathname):
 
@@ -149,60 +164,355 @@ class SynonymChapter:
         with open(pathname, newline='') as csvfile:
             reader = csv.reader(csvfile, delimiter='\t')
 
-            for row in reader:
-                rows.append(row)
+            # A pair is in two lines of number, word and explanation, as
+            # toDict reads them
+            lines = [line for line in reader]
+
+            for index in range(int(len(lines) / 2)):
+                part1 = lines[index * 2]
+                part2 = lines[index * 2 + 1]
+
+                rows.append([part1[1].strip(), part1[2].strip(),
+                             part2[1].strip(), part2[2].strip()])
 
         if len(rows) == 0:
             return
 
-        self.studyRows(rows)
+        self.studyRows(rows, ReviewScheduler(pathname))
+
+    # A row is a pair of word1, explanation1, word2 and explanation2. Only
+    # the rows which are due are shown, a skipped one is remembered and the
+    # others are shown again until they are skipped. A row is graded only
+    # when it is shown first in the session
+    def studyRows(self, rows, scheduler=None):
 
-    def studyRows(self, rows):
+        if scheduler is None:
+            scheduler = ReviewScheduler()
 
-        synonym = Synonym(self.tts)
+        synonym = Synonym(self.getTts())
 
         random.seed()
 
+        rowDict = dict()
+        for row in rows:
+            key = '\t'.join(row)
+            rowDict[key] = row
+            scheduler.add(key)
+
+        os.system('clear')
+
+        prYellow(''.join(['='] * 100))
+        prYellow('{} of {} synonymes are due.'.format(scheduler.getDueCount(), len(rowDict)))
+
         prRed('Notice: press return key to skip one word')
 
-        while len(rows) > 0:
+        reviewedKeys = set()
 
-            size = len(rows)
+        try:
+            while True:
 
-            os.system('clear')
+                key = scheduler.pop()
+                if key is None:
+                    break
 
-            prYellow(''.join(['='] * 100))
-            prYellow('{} synonymes are left.'.format(size))
+                skiped = synonym.study(rowDict[key])
 
-            indexes = [False] * size
-            skipedIndexes = []
+                if key in reviewedKeys:
+                    if not skiped:
+                        scheduler.repeat(key)
+                elif skiped:
+                    scheduler.review(key, ReviewScheduler.REMEMBERED)
+                    reviewedKeys.add(key)
+                else:
+                    scheduler.review(key, ReviewScheduler.FORGOTTEN)
+                    reviewedKeys.add(key)
+        finally:
+            scheduler.save()
 
-            while True:
-                index = 0
+        due = scheduler.getNextDue()
+        if due is not None:
+            prGreen('Nothing is due, the next one is at {}.'.format(
+                datetime.fromtimestamp(due).strftime('%Y-%m-%d %H:%M:%S')))
+
+    def test(self):
+        pass
+
+
+def reportDuplicate(key, formerChapter, latterChapter):
+    prYellow('Duplicate {} in chapter {} is replaced by chapter {}'.format(
+        key, formerChapter, latterChapter))
+
+
+# Run in a worker process
+def exportChapter(task):
+
+    chapterNumber, pathname, configPathname, extra, compress = task
+
+    chapter = SynonymChapter()
+
+    return chapterNumber, chapter.toDict(pathname, configPathname, extra, compress=compress)
+
+
+# Write the JSON of a book chapter by chapter, byte for byte the same as
+# reprDict of the whole dict. The entries of a chapter are sorted and spilled
+# into a temporary file, and the files are merged at last, with the later
+# chapter winning as dict.update does, so only one chapter is in memory.
+class SynonymJsonWriter:
+
+    INDENT = 4
+
+    def __init__(self, compress=False):
+
+        self.compress = compress
+
+        self.tempDir = tempfile.TemporaryDirectory()
+
+        self.spillPathnames = []
+        self.names = []
+
+    # Keys of the top level and the synonyms
+    @staticmethod
+    def getKeys(compress):
+
+        if compress:
+            return 'd', 's'
+
+        return 'date', 'synonyms'
+
+    # The same as the entry in reprDict of the whole dict
+    def render(self, key, value):
+
+        if self.compress:
+            text = '{}: {}'.format(json.dumps(key, ensure_ascii=False),
+                    json.dumps(value, ensure_ascii=False, indent=0, sort_keys=True))
+            return text.replace('\n', '').replace('": ', '":')
+
+        prefix = ' ' * (SynonymJsonWriter.INDENT * 2)
 
-                pos = random.randint(0, size - 1)
+        text = json.dumps(value, ensure_ascii=False, indent=SynonymJsonWriter.INDENT, sort_keys=True)
 
-                for offset in range(size):
-                    index = (pos + offset) % size
-                    if not indexes[index]:
-                        indexes[index] = True
-                        break
+        return '{}{}: {}'.format(prefix, json.dumps(key, ensure_ascii=False),
+                text.replace('\n', '\n' + prefix))
+
+    # name tells where the results are from, if a key is duplicated
+    def add(self, results, name=None):
+
+        pathname = os.path.join(self.tempDir.name, '{}.jsonl'.format(len(self.spillPathnames)))
+
+        with open(pathname, 'w') as fp:
+            for key in sorted(results.keys()):
+                fp.write(json.dumps([key, self.render(key, results[key])], ensure_ascii=False))
+                fp.write('\n')
+
+        self.spillPathnames.append(pathname)
+        self.names.append(name)
+
+    @staticmethod
+    def readSpill(index, pathname):
+
+        with open(pathname) as fp:
+            for line in fp:
+                key, text = json.loads(line)
+                yield key, index, text
+
+    # Yield the entries in the order of keys, the last one of a key wins
+    def merge(self):
+
+        lastKey = None
+        lastIndex = None
+        lastText = None
+
+        spills = [SynonymJsonWriter.readSpill(index, pathname)
+                for index, pathname in enumerate(self.spillPathnames)]
+
+        for key, index, text in heapq.merge(*spills):
+
+            if lastText is not None:
+                if key != lastKey:
+                    yield lastText
                 else:
-                    break  # Not found
+                    reportDuplicate(key, self.names[lastIndex], self.names[index])
+
+            lastKey = key
+            lastIndex = index
+            lastText = text
+
+        if lastText is not None:
+            yield lastText
+
+    def write(self, fp, date):
+
+        try:
+            SynonymJsonWriter.writeContent(fp, date, self.merge(), self.compress)
+        finally:
+            self.tempDir.cleanup()
+
+    # Write rendered entries, or null if entries is None
+    @staticmethod
+    def writeContent(fp, date, entries, compress):
+
+        dateKey, synonymsKey = SynonymJsonWriter.getKeys(compress)
+
+        if compress:
+            separator = ','
+            fp.write('{{"{}":{},"{}":'.format(dateKey, date, synonymsKey))
+        else:
+            indent = ' ' * SynonymJsonWriter.INDENT
+            separator = ',\n'
+            fp.write('{{\n{}"{}": {},\n{}"{}": '.format(indent, dateKey, date, indent, synonymsKey))
+
+        if entries is None:
+            fp.write('null')
+        else:
+            isEmpty = True
+
+            for text in entries:
+
+                if isEmpty:
+                    fp.write('{' if compress else '{\n')
+                    isEmpty = False
+                else:
+                    fp.write(separator)
+
+                fp.write(text)
+
+            if isEmpty:
+                fp.write('{}')
+            else:
+                fp.write('}' if compress else '\n{}}}'.format(indent))
+
+        fp.write('}' if compress else '\n}')
+
+
+# Files of a book with the numbers in their names, kept in the book so the
+# directories are not walked and the names are not parsed again. Only the
+# directories whose mtime is changed are scanned, and the index is saved if
+# any entry is changed. A directory modified in the last SETTLE_TIME seconds
+# could be modified again with the same mtime, so it is scanned next time.
+class BookIndex:
+
+    DIRNAME = '.index'
+    FILENAME = 'book.json'
+
+    VERSION = 1
+    SETTLE_TIME = 2  # seconds
+
+    def __init__(self, bookDir):
+
+        self.bookDir = bookDir
 
-                skiped = synonym.study(rows[index])
-                if skiped:
-                    skipedIndexes.append(index)
+        self.indexDir = os.path.join(bookDir, BookIndex.DIRNAME)
+        self.pathname = os.path.join(self.indexDir, BookIndex.FILENAME)
 
-            if len(skipedIndexes) == 0:
+        self.dirs = dict()
+
+        self.read()
+
+    # The numbers of a page, or the only number of a chapter
+    @staticmethod
+    def getNumbers(pathname):
+        return getNumbers(pathname) or [getNumber(pathname)]
+
+    def read(self):
+
+        try:
+            with open(self.pathname) as fp:
+                index = json.loads(fp.read())
+        except (OSError, ValueError):
+            return
+
+        if index.get('version') != BookIndex.VERSION or index.get('root') != self.bookDir:
+            return
+
+        self.dirs = index['dirs']
+
+    def save(self):
+
+        index = {
+            'version': BookIndex.VERSION,
+            'root': self.bookDir,
+            'dirs': self.dirs,
+        }
+
+        try:
+            mkdir(self.indexDir)
+            writeAtomically(self.pathname, json.dumps(index, ensure_ascii=False))
+        except OSError as e:
+            prYellow('Failed to save the index of {}: {}'.format(self.bookDir, e))
+
+    def scan(self, dirpath, mtime):
+
+        dirs = []
+        files = dict()
+
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+
+                if entry.is_dir():
+                    # Linked directories are not walked, as os.walk does
+                    if entry.is_symlink() or entry.path == self.indexDir:
+                        continue
+
+                    dirs.append(entry.name)
+                else:
+                    files[entry.name] = BookIndex.getNumbers(entry.path)
+
+        if time.time_ns() - mtime < BookIndex.SETTLE_TIME * 1000000000:
+            mtime = None
+
+        return {'mtime': mtime, 'dirs': sorted(dirs), 'files': files}
+
+    def refresh(self):
+
+        dirs = dict()
+        isChanged = False
+
+        dirpaths = [self.bookDir]
+
+        while dirpaths:
+
+            dirpath = dirpaths.pop()
+
+            entry = self.dirs.get(dirpath)
+
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+
+                if entry is None or entry['mtime'] != mtime:
+                    scannedEntry = self.scan(dirpath, mtime)
+
+                    if scannedEntry != entry:
+                        entry = scannedEntry
+                        isChanged = True
+
+            except OSError as e:
+                prRed('Failed to scan {}: {}'.format(dirpath, e))
                 continue
 
-            skipedIndexes = sorted(skipedIndexes, reverse=True)
-            for index in skipedIndexes:
-                rows.pop(index)
+            dirs[dirpath] = entry
 
-    def test(self):
-        pass
+            for name in entry['dirs']:
+                dirpaths.append(os.path.join(dirpath, name))
+
+        if dirs.keys() != self.dirs.keys():
+            isChanged = True
+
+        self.dirs = dirs
+
+        if isChanged:
+            self.save()
+
+    # Return [(pathname, numbers)] of the files with suffix in order
+    def getFiles(self, suffix=None):
+
+        files = []
+
+        for dirpath, entry in self.dirs.items():
+            for name, numbers in entry['files'].items():
+                if suffix is None or name.endswith(suffix):
+                    files.append((os.path.join(dirpath, name), numbers))
+
+        return sorted(files)
 
 
 class SynonymBook:
@@ -237,82 +547,85 @@ class SynonymBook:
 
         return self.chapterDict[chapterKey]
 
-    def extend(self, pathname):
+    def extend(self, pathname, numbers=None):
+
+        if numbers is None:
+            numbers = BookIndex.getNumbers(pathname)
 
         # TODO: remove
-        numbers = getNumbers(pathname)
-        if numbers:
+        if len(numbers) != 1:
             return
 
-        chapterNumber = getNumber(pathname)
+        chapterNumber = numbers[0]
         if chapterNumber == 0:
             return
 
-        self.chapterNumbers.append(chapterNumber)
+        insertSorted(self.chapterNumbers, chapterNumber)
 
         chapterKey = self.getChapterKey(chapterNumber)
         self.chapterDict[chapterKey] = pathname
 
-    def extendWithPage(self, pathname):
+    def extendWithPage(self, pathname, numbers=None):
 
-        numbers = getNumbers(pathname)
+        if numbers is None:
+            numbers = BookIndex.getNumbers(pathname)
 
-        if not numbers or len(numbers) != 2:
+        if len(numbers) != 2:
             return
 
         chapterNumber = numbers[0]
         pageNumber = numbers[1]
 
-        if chapterNumber not in self.chapterNumbers:
-            self.chapterNumbers.append(chapterNumber)
-            self.chapterNumbers = sorted(self.chapterNumbers)
+        insertSorted(self.chapterNumbers, chapterNumber)
 
         chapterKey = self.getChapterKey(chapterNumber)
 
-        if chapterKey in self.chapterDict.keys():
-            chapter = self.chapterDict[chapterKey]
-        else:
-            chapter = dict()
-            chapter['pages'] = []
+        chapter = self.chapterDict.setdefault(chapterKey, {'pages': []})
 
-        chapter['pages'].append(pageNumber)
-        chapter['pages'] = sorted(chapter['pages'])
+        insertSorted(chapter['pages'], pageNumber)
 
         pageKey = self.getPageKey(pageNumber)
         chapter[pageKey] = pathname
 
-        self.chapterDict[chapterKey] = chapter
+    # Chapters are loaded from files of chapters, or of pages if isPage
+    def load(self, suffix='.csv', isPage=False):
 
-    def load(self, suffix='.csv'):
+        index = BookIndex(self.bookDir)
+        index.refresh()
 
-        pathnames = getPathnames(self.bookDir, suffix)
+        files = index.getFiles(suffix)
 
-        num = len(pathnames)
-        if num == 0:
+        if len(files) == 0:
             prRed('No file is found in {}'.format(self.bookDir))
             return False
 
-        for pathname in pathnames:
-            self.extend(pathname)
+        for pathname, numbers in files:
+
+            # Left by a page or a chapter failed to be parsed
+            if pathname.endswith('.error{}'.format(suffix)):
+                continue
+
+            if isPage:
+                self.extendWithPage(pathname, numbers)
+            else:
+                self.extend(pathname, numbers)
 
         return True
 
     def loadRaw(self):
-        return self.load('.txt')
+        return self.load('.txt', isPage=True)
 
-    def toDict(self, configDir, configPathname, compress=False):
+    # Yield (chapter number, dict) of every chapter in order, which are
+    # exported in worker processes. The book has to be loaded.
+    def iterateChapters(self, configDir, configPathname, compress=False, processes=None):
 
         def loadConfig(configPathname):
             with open(configPathname) as fp:
                 return json.loads(fp.read())
 
-        if not self.load():
-            return None
-
         config = loadConfig(configPathname)
 
-        wholeResults = dict()
-        chapter = SynonymChapter()
+        tasks = []
 
         for chapterNumber in self.chapterNumbers:
             filename = config['{}'.format(chapterNumber)]['filename']
@@ -328,7 +641,27 @@ class SynonymBook:
                     'chapter': chapterNumber,
                 }
 
-            results = chapter.toDict(pathname, configPathname, extra, compress=compress)
+            tasks.append((chapterNumber, pathname, configPathname, extra, compress))
+
+        with multiprocessing.Pool(processes) as pool:
+            yield from pool.imap(exportChapter, tasks)
+
+    def toDict(self, configDir, configPathname, compress=False):
+
+        if not self.load():
+            return None
+
+        wholeResults = dict()
+        chapterNumbers = dict()
+
+        for chapterNumber, results in self.iterateChapters(configDir, configPathname, compress):
+
+            for key in results.keys():
+                if key in chapterNumbers.keys():
+                    reportDuplicate(key, chapterNumbers[key], chapterNumber)
+
+                chapterNumbers[key] = chapterNumber
+
             wholeResults.update(results)
 
         return wholeResults
@@ -336,25 +669,28 @@ class SynonymBook:
     def saveToFile(self, pathname, configDir, configPathname, compress=False):
 
         with open(pathname, 'w+', newline='') as fp:
-            synonyms = self.toDict(configDir, configPathname, compress)
 
-            if compress:
-                content = {
-                    'd': int(datetime.now().timestamp()),
-                    's': synonyms,
-                }
-                data = reprDict(content, indent=0).replace(
-                    '\n', '').replace('": ', '":')
+            date = int(datetime.now().timestamp())
+
+            if not self.load():
+                SynonymJsonWriter.writeContent(fp, date, None, compress)
             else:
-                content = {
-                    'date': int(datetime.now().timestamp()),
-                    'synonyms': synonyms,
-                }
-                data = reprDict(content)
+                writer = SynonymJsonWriter(compress)
+
+                for chapterNumber, results in self.iterateChapters(configDir, configPathname, compress):
+                    writer.add(results, chapterNumber)
+
+                writer.write(fp, date)
 
-            fp.write(data)
             prGreen('Save to {}'.format(pathname))
 
+    def saveToBundle(self, pathname, configDir, configPathname, compression='none'):
+
+        synonyms = self.toDict(configDir, configPathname, compress=True)
+
+        size = SynonymBundle.save(pathname, int(datetime.now().timestamp()), synonyms, compression)
+        prGreen('Save {} synonyms to {} in {} bytes'.format(len(synonyms), pathname, size))
+
     def study(self):
 
         def readNumber(array, promptPrefix, timeout):
@@ -383,7 +719,8 @@ class SynonymBook:
                 index = random.randint(0, len(array) - 1)
                 return array[index]
 
-        if not self.load():
+        # Pages are studied one by one
+        if not self.load(isPage=True):
             return
 
         random.seed()
@@ -407,6 +744,9 @@ def run(name, configFile, pathname):
 
     synonymPath = getProperty(configFile, 'synonym-path')
 
+    AudioCache.init(getProperty(configFile, 'audio-cache-path'))
+    Player.init(getProperty(configFile, 'audio-player'))
+
     try:
         book = SynonymBook(synonymPath)
 
@@ -426,7 +766,15 @@ def run(name, configFile, pathname):
                 if flag == 'Y':
                     compress = True
 
-            book.saveToFile(pathname, configDir, configPathname, compress)
+            if pathname.endswith(SynonymBundle.SUFFIX):
+
+                compression = 'none'
+                if compress:
+                    compression = 'zstd' if zstandard is not None else 'gzip'
+
+                book.saveToBundle(pathname, configDir, configPathname, compression)
+            else:
+                book.saveToFile(pathname, configDir, configPathname, compress)
         else:
             os.system('clear')
             print('Now: ', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
@@ -445,7 +793,7 @@ def run(name, configFile, pathname):
 def main(argv):
 
     if len(argv) < 2:
-        print('Usage:\n\t', argv[0], '[SAVE-PATH-NAME]\n')
+        print('Usage:\n\t', argv[0], '[SAVE-PATH-NAME[{}]]\n'.format(SynonymBundle.SUFFIX))
 
     os.environ['TZ'] = 'Asia/Shanghai'
     time.tzset()
@@ -1,16 +1,21 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import atexit
 import hashlib
 import json
 import pyttsx3
+import threading
 import urllib.parse
 
+from cache import AudioCache
 from network import Network
+from player import Player
 
 
 class Tts:
 
+    BACKEND = 'oddcast'
     CONFIG_FILE = 'templates/tts.json'
 
     def __init__(self):
@@ -48,8 +53,9 @@ class Tts:
         accountId = self.config['accountId']
         secretId = self.config['secretId']
 
-        preparation = self.config['preparation']
-        download = self.config['download']
+        # Copy them, as texts may be generated in several threads
+        preparation = dict(self.config['preparation'])
+        download = dict(self.config['download'])
 
         languageId = self.language['languageId']
         voiceId = self.language['voiceIds'][self.voiceIndex]
@@ -88,9 +94,116 @@ class Tts:
 
         return Network.saveUrl(prefix, downloadUrl)
 
+    def render(self, text):
+
+        if self.voiceIndex is None:
+            self.switchVoice()
+
+        key = AudioCache.getKey(text, self.language['name'],
+                                self.language['voiceIds'][self.voiceIndex], None, Tts.BACKEND)
+
+        return AudioCache.get().fetch(key, lambda prefix: self.generateTts(prefix, text))
+
+    def renderAll(self, texts, concurrency=None):
+
+        if self.voiceIndex is None:
+            self.switchVoice()
+
+        return Network.batch(self.render, texts, concurrency)
+
+    # Nothing is played if cancelEvent is set while it is being rendered
+    def say(self, text, speed=1.0, cancelEvent=None):
+
+        pathname = self.render(text)
+        if pathname is None:
+            print('Failed to say', text)
+            return
+
+        if cancelEvent is not None and cancelEvent.is_set():
+            return
+
+        Player.get().play(pathname, speed)
+
+
+# pyttsx3 hands out one engine per driver but only holds it weakly, so an
+# engine created per utterance restarts the driver every time. Keep it alive
+# for the whole process; a (voiceId, rate) pair selects the voice, and as all
+# of them share the driver, switching only sets the properties that differ.
+class LocalEngine:
+
+    DEFAULT_RATE = 200
+
+    _instance = None
+
+    def __init__(self):
+
+        self.engine = None
+
+        self.voiceId = None
+        self.rate = None
+
+        self.mutex = threading.RLock()
+
+        atexit.register(self.shutdown)
+
+    @staticmethod
+    def get():
+
+        if LocalEngine._instance is None:
+            LocalEngine._instance = LocalEngine()
+
+        return LocalEngine._instance
+
+    def acquire(self, voiceId, rate):
+
+        if self.engine is None:
+            self.engine = pyttsx3.init()
+
+        if self.voiceId != voiceId:
+            self.engine.setProperty('voice', voiceId)
+            self.voiceId = voiceId
+
+        if self.rate != rate:
+            self.engine.setProperty('rate', rate)     # setting up new voice rate
+            self.rate = rate
+
+        return self.engine
+
+    def say(self, voiceId, rate, text):
+
+        with self.mutex:
+            engine = self.acquire(voiceId, rate)
+
+            engine.say(text)
+            engine.runAndWait()
+
+    def save(self, voiceId, rate, text, pathname):
+
+        with self.mutex:
+            engine = self.acquire(voiceId, rate)
+
+            engine.save_to_file(text, pathname)
+            engine.runAndWait()
+
+    def shutdown(self):
+
+        with self.mutex:
+            if self.engine is None:
+                return
+
+            try:
+                self.engine.stop()
+            except Exception as e:
+                print('Error to stop engine:', e)
+
+            self.engine = None
+            self.voiceId = None
+            self.rate = None
+
 
 class LocalTts:
 
+    BACKEND = 'pyttsx3'
     CONFIG_FILE = 'templates/local-tts.json'
 
     def __init__(self):
@@ -119,43 +232,58 @@ class LocalTts:
             if self.voiceIndex >= len(self.language['voiceIds']):
                 self.voiceIndex = 0
 
+    def getVoiceId(self):
+        return self.language['voiceIds'][self.voiceIndex]
+
     def generateTts(self, prefix, text, speed=1.0):
 
         self.switchVoice()
 
-        DEFAULT_RATE = 200
+        rate = int(LocalEngine.DEFAULT_RATE * speed)
 
-        engine = pyttsx3.init()
+        pathname = '{}.mp3'.format(prefix)
+        LocalEngine.get().save(self.getVoiceId(), rate, text, pathname)
 
-        voiceId = self.language['voiceIds'][self.voiceIndex]
-        engine.setProperty('voice', voiceId)
+        return pathname
 
-        rate = int(DEFAULT_RATE * speed)
-        engine.setProperty('rate', rate)     # setting up new voice rate
+    # Return the cache key of text in the current voice and a function that
+    # renders it into a file
+    def prepare(self, text, speed=1.0):
 
-        pathname = '{}.mp3'.format(prefix)
-        engine.save_to_file(text, pathname)
+        voiceId = self.getVoiceId()
+        rate = int(LocalEngine.DEFAULT_RATE * speed)
 
-        engine.runAndWait()
-        engine.stop()
+        def generate(prefix):
 
-        return pathname
+            pathname = '{}.mp3'.format(prefix)
+            LocalEngine.get().save(voiceId, rate, text, pathname)
+
+            return pathname
+
+        key = AudioCache.getKey(text, self.language['name'], voiceId, rate, LocalTts.BACKEND)
 
-    def say(self, text, speed=1.0):
+        return key, generate
+
+    def render(self, text, speed=1.0):
 
         self.switchVoice()
 
-        DEFAULT_RATE = 200
+        key, generate = self.prepare(text, speed)
 
-        engine = pyttsx3.init()
+        return AudioCache.get().fetch(key, generate)
 
-        voiceId = self.language['voiceIds'][self.voiceIndex]
-        engine.setProperty('voice', voiceId)
+    # Nothing is played if cancelEvent is set while it is being rendered
+    def say(self, text, speed=1.0, cancelEvent=None):
+
+        pathname = self.render(text, speed)
 
-        rate = int(DEFAULT_RATE * speed)
-        engine.setProperty('rate', rate)     # setting up new voice rate
+        if cancelEvent is not None and cancelEvent.is_set():
+            return
 
-        engine.say(text)
+        if pathname is None:
+            # Speak it directly if it could not be rendered into a file
+            LocalEngine.get().say(self.getVoiceId(),
+                                  int(LocalEngine.DEFAULT_RATE * speed), text)
+            return
 
-        engine.runAndWait()
-        engine.stop()
+        Player.get().play(pathname)
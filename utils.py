@@ -3,6 +3,7 @@
 
 # Utils
 import binascii
+import bisect
 import hashlib
 import json
 import os
@@ -107,6 +108,20 @@ def remove(path):
     if os.path.exists(path):
         os.remove(path)
 
+def writeAtomically(pathname, content, mode='w'):
+
+    tempPathname = '{}.{}-{}.tmp'.format(pathname, os.getpid(), threading.get_ident())
+
+    try:
+        with open(tempPathname, mode) as fp:
+            fp.write(content)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        os.replace(tempPathname, pathname)
+    finally:
+        remove(tempPathname)
+
 def getPathnames(dirpath, suffix=None):
 
     pathnames = list()
@@ -123,6 +138,14 @@ def getPathnames(dirpath, suffix=None):
 
     return pathnames
 
+# Insert value into the sorted array unless it is already there
+def insertSorted(array, value):
+
+    index = bisect.bisect_left(array, value)
+
+    if index == len(array) or array[index] != value:
+        array.insert(index, value)
+
 def getMd5(content):
 
     md5_hash = hashlib.md5()  
@@ -141,6 +164,23 @@ def getFileMd5(path):
 
     return None
 
+def getDigest(content):
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+# Hash the raw bytes in chunks, so a file is never decoded nor loaded at once
+def getFileDigest(path, chunkSize=1024 * 1024):
+
+    if not os.path.exists(path):
+        return None
+
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunkSize), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
 def getch(timeout=-1, isPrompt=True):
 
     if isPrompt:
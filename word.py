@@ -2,16 +2,15 @@
 # -*- coding:utf-8 -*-
 
 import copy
-import hashlib
-import os
-import time
 
+from audio import LetterBank
 from tts import LocalTts as Tts
-from utils import playSound
 
 
 class Word:
 
+    LETTER_GAP = 0.1  # seconds
+
     def __init__(self, dirname, content):
 
         self.dirname = dirname
@@ -46,7 +45,7 @@ class Word:
 
         return self.samples[index]
 
-    def say(self, content, language='english', speed=1.0):
+    def say(self, content, language='english', speed=1.0, cancelEvent=None):
 
         content = content.strip()
         if 0 == len(content):
@@ -55,7 +54,7 @@ class Word:
         tts = Tts()
         tts.setLanguage(language)
 
-        tts.say(content, speed)
+        tts.say(content, speed, cancelEvent)
 
     def generateTts(self, content, language='english', speed=1.0):
 
@@ -63,42 +62,42 @@ class Word:
         if 0 == len(content):
             return None
 
-        md5 = hashlib.md5(content.encode('utf8')).hexdigest()
-        prefix = os.path.join(self.dirname, md5)
-
-        pathname = '{}.mp3'.format(prefix)
-        if os.path.exists(pathname):
-            return pathname
-
         tts = Tts()
         tts.setLanguage(language)
 
-        pathname = tts.generateTts(prefix, content, speed)
+        return tts.render(content, speed)
 
-        return pathname
+    # Render all audio which would be played
+    def prefetch(self):
 
-    def playChinese(self):
-        self.say(self.chinese, 'chinese')
+        self.generateTts(self.explanation)
+        self.generateTts(self.chinese, 'chinese')
+        self.generateTts(self.english)
+        self.generateTts(self.getSample())
 
-    def playEnglish(self):
-        self.say(self.english)
+        if self.letters:
+            LetterBank.get()
 
-    def playExplanation(self):
-        self.say(self.explanation)
+    def playChinese(self, cancelEvent=None):
+        self.say(self.chinese, 'chinese', cancelEvent=cancelEvent)
 
-    def playSample(self, index=0):
+    def playEnglish(self, cancelEvent=None):
+        self.say(self.english, cancelEvent=cancelEvent)
+
+    def playExplanation(self, cancelEvent=None):
+        self.say(self.explanation, cancelEvent=cancelEvent)
+
+    def playSample(self, index=0, cancelEvent=None):
 
         if index >= len(self.samples):
             return
 
         sample = self.samples[index]
-        self.say(sample)
+        self.say(sample, cancelEvent=cancelEvent)
 
-    def playLetters(self):
+    def playLetters(self, gap=LETTER_GAP, cancelEvent=None):
 
-        pathnames = list()
+        if not self.letters:
+            return
 
-        for letter in self.letters:
-            pathname = self.generateTts(letter)
-            playSound(pathname)
-            time.sleep(0.1)
+        LetterBank.get().play(self.letters, gap, cancelEvent)
@@ -3,6 +3,7 @@
 
 import csv
 import json
+import multiprocessing
 import os
 import random
 import re
@@ -11,9 +12,9 @@ import time
 import traceback
 
 from datetime import datetime
-from phrase import SentenceGroup, getNumbers
+from phrase import Corrections, RuleProfiler, Sentence, SentenceGroup, getNumbers
 from tts import LocalTts as Tts
-from utils import getMd5, getFileMd5, remove, reprDict, runCommand, getch, getchar, getPathnames, getProperty, prGreen, prRed, prYellow, prLightPurple, prPurple, prCyan, prLightGray, prBlack, stdinReadline
+from utils import getDigest, getFileDigest, getMd5, getFileMd5, remove, reprDict, writeAtomically, runCommand, getch, getchar, getPathnames, getProperty, prGreen, prRed, prYellow, prLightPurple, prPurple, prCyan, prLightGray, prBlack, stdinReadline
 
 
 class SynonymSaver:
@@ -102,17 +103,26 @@ class SynonymPage(SentenceGroup):
 
     def refine(self, pathname, info):
 
-        content = ''
+        parts = []
         size = len(self.group)
         mid = int(size / 2) - 1
         for index in range(size):
-            content += self.group[index] + '\n'
+            parts.append(self.group[index])
+            parts.append('\n')
 
             if index == mid:
-                content += '\n\n\n'
+                parts.append('\n\n\n')
 
-        if info and info['md5code'] == getMd5(content):
-            return False
+        content = ''.join(parts)
+
+        if info:
+            if 'digest' in info.keys():
+                isSame = info['digest'] == getDigest(content)
+            else:
+                isSame = info.get('md5code') == getMd5(content)
+
+            if isSame:
+                return False
 
         with open(pathname, 'w+', newline='') as fp:
             fp.write(content)
@@ -171,6 +181,14 @@ class Chapter:
         if not page.read(pathname, info):
             return False
 
+        self.add(pathname, page.group)
+
+        return True
+
+    # Pages have to be added in order, a chapter is saved once the next one
+    # begins
+    def add(self, pathname, group):
+
         numbers = getNumbers(pathname)
         chapterNumber = numbers[0]
 
@@ -182,9 +200,7 @@ class Chapter:
         self.prefix = pathname[:pos]
 
         self.currentChapter = chapterNumber
-        self.group.extend(page.group)
-
-        return True
+        self.group.extend(group)
 
     def save(self):
         if self.currentChapter < 0:
@@ -192,17 +208,77 @@ class Chapter:
 
         return SynonymSaver.save(self.prefix, self.group)
 
+    def flush(self):
+
+        self.save()
+
+        self.reset()
+        self.currentChapter = -1
+
+
+# Run in worker processes before any page, which may be spawned rather than
+# forked, so the settings of the main process are given again
+def initParser(phrasesPath, isProfiling):
+
+    Corrections.init(phrasesPath)
+
+    if isProfiling:
+        RuleProfiler.enable()
+
+
+# Run in a worker process, and return the group of a page or None if it
+# fails to be parsed, with the records of the rules and the cache of lines
+# in the parsing, which are merged by the main process
+def parsePage(task):
+
+    pathname, info = task
+
+    page = SynonymPage()
+    group = None
+
+    cacheInfo = Sentence.getCacheInfo()
+
+    try:
+        if page.read(pathname, info):
+            group = page.group
+    except Exception as e:
+        prRed('Error to parse {}: {}'.format(pathname, e))
+        traceback.print_exc(file=sys.stdout)
+
+    newCacheInfo = Sentence.getCacheInfo()
+
+    stats = {
+        'hits': newCacheInfo['hits'] - cacheInfo['hits'],
+        'misses': newCacheInfo['misses'] - cacheInfo['misses'],
+    }
+
+    profiler = RuleProfiler.get()
+    if profiler is not None:
+        stats['profile'] = profiler.collect()
+
+    return pathname, group, stats
+
 
+# Parsed pages are kept in dictionary.json. Every update is appended to a
+# journal at once, so the progress survives an interrupted run, and the
+# journal is compacted into dictionary.json, which is replaced atomically,
+# once it has COMPACT_SIZE entries or the dictionary is saved.
 class SynonymDictionary:
 
+    COMPACT_SIZE = 256
+
     def __init__(self, dirname):
 
         self.dirname = dirname
 
         self.dictpath = os.path.join(dirname, 'dictionary.json')
+        self.journalPath = os.path.join(dirname, 'dictionary.journal')
 
         self.dictionary = dict()
 
+        self.journal = None
+        self.journalSize = 0
+
         self.load()
 
     def __del__(self):
@@ -210,16 +286,69 @@ class SynonymDictionary:
 
     def load(self):
 
-        if not os.path.exists(self.dictpath):
+        if os.path.exists(self.dictpath):
+            try:
+                with open(self.dictpath) as fp:
+                    content = json.loads(fp.read())
+                    self.dictionary.update(content)
+            except ValueError as e:
+                prRed('Error to load {}: {}'.format(self.dictpath, e))
+
+        if not os.path.exists(self.journalPath):
             return
 
-        with open(self.dictpath) as fp:
-            content = json.loads(fp.read())
-            self.dictionary.update(content)
+        offset = 0
+
+        with open(self.journalPath, 'rb') as fp:
+            for line in fp:
+
+                # The last one is cut by an interrupted run
+                if not line.endswith(b'\n'):
+                    break
+
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
 
+                self.dictionary[entry['key']] = entry['info']
+                self.journalSize += 1
+
+                offset += len(line)
+
+        # Cut it off, or the following entries would be appended to it
+        if offset < os.path.getsize(self.journalPath):
+            prYellow('Truncate {} at {}'.format(self.journalPath, offset))
+            os.truncate(self.journalPath, offset)
+
+    def append(self, key, info):
+
+        if self.journal is None:
+            self.journal = open(self.journalPath, 'a')
+
+        self.journal.write('{}\n'.format(json.dumps({'key': key, 'info': info}, ensure_ascii=False)))
+        self.journal.flush()
+
+        self.journalSize += 1
+
+        if self.journalSize >= SynonymDictionary.COMPACT_SIZE:
+            self.save()
+
+    # Compact the journal into dictionary.json
     def save(self):
-        with open(self.dictpath, 'w+', newline='') as fp:
-            fp.write(reprDict(self.dictionary))
+
+        if self.journalSize == 0:
+            return
+
+        writeAtomically(self.dictpath, reprDict(self.dictionary))
+
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+        remove(self.journalPath)
+
+        self.journalSize = 0
 
     def getkey(self, pathname):
         return pathname.replace('/', '-').replace('\\', '-').replace('.', '-')
@@ -231,33 +360,72 @@ class SynonymDictionary:
 
         return self.dictionary[key]
 
+    @staticmethod
+    def getStat(pathname):
+
+        stat = os.stat(pathname)
+
+        return {
+            'size': stat.st_size,
+            'mtime-ns': stat.st_mtime_ns,
+            'inode': stat.st_ino,
+        }
+
+    # A file is hashed only if its size, mtime or inode is changed, and it
+    # is parsed again only if its content is changed too
     def isParsed(self, pathname):
 
         info = self.getInfo(pathname)
         if not info:
             return False
 
-        if info['timestamp'] != int(os.path.getmtime(pathname)):
+        csvPathname = '{}.csv'.format(pathname[:-4])
+        if not os.path.exists(csvPathname):
             return False
 
-        if info['md5code'] != getFileMd5(pathname):
+        stat = SynonymDictionary.getStat(pathname)
+
+        if all([info.get(key) == value for key, value in stat.items()]):
+            return True
+
+        if 'digest' in info.keys():
+            digest = getFileDigest(pathname)
+            isSame = info['digest'] == digest
+        else:
+            # Parsed by an old version
+            digest = None
+            isSame = info.get('md5code') == getFileMd5(pathname)
+
+        if not isSame:
             return False
 
-        csvPathname = '{}.csv'.format(pathname[:-4])
-        return os.path.exists(csvPathname)
+        # Touched or copied, remember it to skip hashing next time
+        self.update(pathname, digest)
+
+        return True
 
-    def update(self, pathname):
+    def update(self, pathname, digest=None):
         key = self.getkey(pathname)
 
-        md5code = getFileMd5(pathname)
-        timestamp = int(os.path.getmtime(pathname))
+        if digest is None:
+            digest = getFileDigest(pathname)
 
-        self.dictionary[key] = {
-            'timestamp': timestamp,
-            'md5code': md5code,
-        }
+        info = SynonymDictionary.getStat(pathname)
 
-    def parse(self):
+        info['timestamp'] = info['mtime-ns'] // 1000000000
+        info['digest'] = digest
+
+        self.dictionary[key] = info
+        self.append(key, info)
+
+    @staticmethod
+    def getChapterNumber(pathname):
+        return getNumbers(pathname)[0]
+
+    # A chapter is parsed again as a whole if any page of it is changed, and
+    # it is saved once all of its pages are parsed. Pages are journaled only
+    # after their chapter is saved, so an interrupted run parses them again.
+    def parse(self, processes=None, phrasesPath=None):
 
         pathnames = getPathnames(self.dirname, '.txt')
 
@@ -270,24 +438,88 @@ class SynonymDictionary:
         failedCount = 0
         skippedCount = 0
 
-        chapter = Chapter()
+        chapters = dict()
+        changedPathnames = set()
 
         for pathname in pathnames:
-            if self.isParsed(pathname):
-                skippedCount += 1
+
+            chapters.setdefault(SynonymDictionary.getChapterNumber(pathname), []).append(pathname)
+
+            if not self.isParsed(pathname):
+                changedPathnames.add(pathname)
+
+        tasks = []
+        pendings = dict()
+
+        for chapterNumber, chapterPathnames in chapters.items():
+
+            if changedPathnames.isdisjoint(chapterPathnames):
+                skippedCount += len(chapterPathnames)
                 continue
 
-            info = self.getInfo(pathname)
+            pendings[chapterNumber] = set(chapterPathnames)
 
-            if chapter.read(pathname, info):
-                self.update(pathname)
-                succeededCount += 1
-            else:
-                failedCount += 1
+            for pathname in chapterPathnames:
+                tasks.append((pathname, self.getInfo(pathname)))
+
+        profiler = RuleProfiler.get()
+        cacheInfo = {'hits': 0, 'misses': 0}
+
+        groups = dict()
+        parsedPathnames = set()
+
+        def saveChapter(chapterNumber):
+
+            chapter = Chapter()
+
+            # In the order of pathnames, as they were read one by one
+            for pathname in chapters[chapterNumber]:
+                if pathname in groups.keys():
+                    chapter.add(pathname, groups.pop(pathname))
+
+            chapter.flush()
+
+            for pathname in chapters[chapterNumber]:
+                if pathname in changedPathnames and pathname in parsedPathnames:
+                    self.update(pathname)
+
+        if len(tasks) > 0:
+
+            # Parse pages in parallel
+            with multiprocessing.Pool(processes, initParser, (phrasesPath, profiler is not None)) as pool:
+
+                for pathname, group, stats in pool.imap_unordered(parsePage, tasks):
+
+                    if profiler is not None:
+                        profiler.merge(stats.pop('profile'))
+
+                    for key in cacheInfo.keys():
+                        cacheInfo[key] += stats[key]
+
+                    if group is None:
+                        failedCount += 1
+                    else:
+                        succeededCount += 1
+
+                        groups[pathname] = group
+                        parsedPathnames.add(pathname)
+
+                    # Put the pages into the chapter in order once all are here
+                    chapterNumber = SynonymDictionary.getChapterNumber(pathname)
+
+                    pending = pendings[chapterNumber]
+                    pending.discard(pathname)
+
+                    if len(pending) == 0:
+                        saveChapter(chapterNumber)
+
+        self.save()
 
         prGreen('Parsed {}, failed {}, skipped {}'.format(
             succeededCount, failedCount, skippedCount))
 
+        prGreen('Refined lines: {} hits, {} misses'.format(cacheInfo['hits'], cacheInfo['misses']))
+
 
 def run(name, configFile, pathname=None):
 
@@ -296,12 +528,15 @@ def run(name, configFile, pathname=None):
 
         synonymPath = getProperty(configFile, 'synonym-path')
 
+        phrasesPath = getProperty(configFile, 'phrases-path')
+        Corrections.init(phrasesPath)
+
         if pathname:
             page = SynonymPage()
             page.read(pathname)
         else:
             dictionary = SynonymDictionary(synonymPath)
-            dictionary.parse()
+            dictionary.parse(phrasesPath=phrasesPath)
 
     except KeyboardInterrupt:
         pass
@@ -315,8 +550,16 @@ def run(name, configFile, pathname=None):
 
 def main(argv):
 
+    # --profile prints a table of the rules, and --profile=json a JSON line
+    profile = None
+    for arg in argv[1:]:
+        if arg.startswith('--profile'):
+            profile = arg
+
+    argv = [arg for arg in argv if not arg.startswith('--profile')]
+
     if len(argv) < 2:
-        print('Usage:\n\t', argv[0], '[PATH-NAME]\n')
+        print('Usage:\n\t', argv[0], '[--profile[=json]] [PATH-NAME]\n')
 
     os.environ['TZ'] = 'Asia/Shanghai'
     time.tzset()
@@ -327,8 +570,14 @@ def main(argv):
     if len(argv) > 1:
         pathname = os.path.realpath(argv[1])
 
+    if profile is not None:
+        RuleProfiler.enable()
+
     run(name, 'config.ini', pathname)
 
+    if profile is not None:
+        RuleProfiler.get().dump(profile == '--profile=json')
+
 
 if __name__ == '__main__':
     main(sys.argv)